@@ -0,0 +1,38 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'usr', 'lib', 'live-installer'))
+
+import superblock
+
+# the BIOS parameter block of an NTFS volume made by Windows: 512 bytes sectors,
+# 8 sectors clusters, 409599 sectors, the MFT at cluster 0xC0000 and its mirror at 2
+NTFS_BOOT_SECTOR = bytes.fromhex(
+    'eb52904e5446532020202000020800000000000000f800003f00ff0000080000'
+    '0000000080008000ff3f06000000000000000c00000000000200000000000000'
+    'f600000001000000372fbec6d1bec6ac00000000'
+)
+
+
+def get_ntfs_head():
+    head = bytearray(8192)
+    head[:len(NTFS_BOOT_SECTOR)] = NTFS_BOOT_SECTOR
+    head[510:512] = b'\x55\xaa'
+    return bytes(head)
+
+
+def test_read_ntfs():
+    info = superblock.read_ntfs(get_ntfs_head())
+    assert info.type == 'ntfs'
+    assert info.size == 409599 * 512
+    # what blkid tells as the UUID of the volume
+    assert info.uuid == 'ACC6BED1C6BE2F37'
+
+
+def test_read_ntfs_is_not_vfat():
+    head = get_ntfs_head()
+    assert superblock.read_vfat(head) is None
+    assert superblock.read_ext(head) is None
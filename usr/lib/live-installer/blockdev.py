@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+import os
+import re
+import json
+import subprocess
+import threading
+
+import commands
+
+# what the device graph is built from, a single "lsblk -J -b -p" run
+LSBLK_COLUMNS = 'NAME,KNAME,PKNAME,TYPE,SIZE,RM,RO,ROTA,MODEL,FSTYPE,UUID,LABEL,PARTUUID,MOUNTPOINT'
+SYSFS_BLOCK = '/sys/class/block'
+# lsblk and blkid open the devices, a dying disk can hang them
+PROBE_TIMEOUT = 60
+
+
+def parse_blkid_export(output):
+    ''' Parses "blkid -o export" output into {devname: {key: value}} '''
+    devices = {}
+    for block in re.split(r'\n\s*\n', output.strip()):
+        values = {}
+        for line in block.splitlines():
+            key, sep, value = line.partition('=')
+            if sep:
+                values[key.strip()] = re.sub(r'\\(.)', r'\1', value.strip())
+        if 'DEVNAME' in values:
+            devices[values.pop('DEVNAME')] = values
+    return devices
+
+
+def _flag(value):
+    # lsblk before 2.33 writes "0" and "1" strings
+    return value in (True, 1, '1')
+
+
+def _read_sysfs(kname, *names):
+    try:
+        with open(os.path.join(SYSFS_BLOCK, os.path.basename(kname), *names)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+class BlockDevice(object):
+    ''' A node of the block device graph, sizes in bytes '''
+
+    def __init__(self, path, kname=None, type=None, size=0, removable=False, readonly=False, rotational=False,
+                 model=None, fstype=None, uuid=None, label=None, partuuid=None, mountpoint=None):
+        self.path = path
+        self.kname = kname or path
+        self.type = type
+        self.size = size
+        self.removable = removable
+        self.readonly = readonly
+        self.rotational = rotational
+        self.model = model
+        self.fstype = fstype
+        self.uuid = uuid
+        self.label = label
+        self.partuuid = partuuid
+        self.mountpoint = mountpoint
+        self.parents = []   # i.e. the disk of a partition, the partitions under a RAID
+        self.children = []  # i.e. the partitions of a disk
+        self.holders = []   # the devices built on top of this one (dm, md), from sysfs
+
+    @classmethod
+    def from_lsblk(cls, entry):
+        kname = entry.get('kname') or entry['name']
+        # older lsblk may not know the column
+        removable, rotational = entry.get('rm'), entry.get('rota')
+        if removable is None:
+            removable = _read_sysfs(kname, 'removable')
+        if rotational is None:
+            rotational = _read_sysfs(kname, 'queue', 'rotational')
+        device = cls(entry['name'], kname, entry.get('type'), int(entry.get('size') or 0),
+                     _flag(removable), _flag(entry.get('ro')), _flag(rotational),
+                     (entry.get('model') or '').strip() or None, entry.get('fstype'), entry.get('uuid'),
+                     entry.get('label'), entry.get('partuuid'), entry.get('mountpoint'))
+        holders = os.path.join(SYSFS_BLOCK, os.path.basename(kname), 'holders')
+        if os.path.isdir(holders):
+            device.holders = sorted('/dev/' + name for name in os.listdir(holders))
+        return device
+
+    def get_values(self):
+        ''' The blkid keys of the filesystem '''
+        values = {'UUID': self.uuid, 'LABEL': self.label, 'TYPE': self.fstype, 'PARTUUID': self.partuuid}
+        return dict((key, value) for key, value in values.items() if value)
+
+    def set_values(self, values):
+        self.uuid, self.label = values.get('UUID'), values.get('LABEL')
+        self.fstype, self.partuuid = values.get('TYPE'), values.get('PARTUUID')
+
+
+def parse_lsblk(output):
+    ''' Parses "lsblk -J -b -p" output into {path: BlockDevice}, linked to their parents and children '''
+    devices = {}
+
+    def _add(entry, parent):
+        device = devices.get(entry['name'])
+        # a device with several parents (i.e. a RAID array) is listed under each of them
+        if device is None:
+            device = devices[entry['name']] = BlockDevice.from_lsblk(entry)
+        if parent is not None and parent.path not in device.parents:
+            device.parents.append(parent.path)
+            parent.children.append(device.path)
+        for child in entry.get('children', ()):
+            _add(child, device)
+
+    for entry in json.loads(output).get('blockdevices', ()):
+        _add(entry, None)
+    return devices
+
+
+class BlockDeviceCache(object):
+    ''' The graph of the block devices: disks, partitions and what they hold, with their
+    filesystem UUID, LABEL, TYPE and PARTUUID.
+
+    The graph is built with a single lsblk run (and sysfs) the first time the
+    cache is used; invalidate() a device after changing it (mkfs, tune2fs,
+    fatlabel) and only that device is probed again, by blkid, on the next lookup.
+    The partitioning screen and the installation share the same cache. '''
+
+    def __init__(self):
+        self._devices = None
+        self._stale = set()
+        self._lock = threading.Lock()
+
+    def _blkid(self, *devices):
+        # -c /dev/null: don't trust blkid.tab, it does not know about the new filesystems
+        result = commands.run(['blkid', '-c', '/dev/null', '-o', 'export'] + list(devices), timeout=PROBE_TIMEOUT,
+                              capture=True, log=None, stderr=subprocess.DEVNULL)
+        return parse_blkid_export("\n".join(result.output))
+
+    def _lsblk(self):
+        result = commands.run(['lsblk', '-J', '-b', '-p', '-o', LSBLK_COLUMNS], timeout=PROBE_TIMEOUT,
+                              capture=True, log=None, stderr=subprocess.DEVNULL)
+        try:
+            return parse_lsblk("\n".join(result.output))
+        except (ValueError, KeyError) as detail:
+            print("WARNING: Could not parse the lsblk output: %s" % detail)
+            return {}
+
+    def _get_devices(self):
+        with self._lock:
+            if self._devices is None:
+                print(" ------ Probing the block devices")
+                self._devices = self._lsblk()
+                self._stale.clear()
+            elif self._stale:
+                # blkid reads the new filesystems, udev (and so lsblk) may not have seen them yet
+                probed = self._blkid(*sorted(self._stale))
+                for path in self._stale:
+                    device = self._devices.get(path)
+                    if device is None:
+                        device = self._devices[path] = BlockDevice(path)
+                    device.set_values(probed.get(path, {}))
+                self._stale.clear()
+            return self._devices
+
+    def probe(self):
+        ''' Probe all the devices now '''
+        self.invalidate()
+        self._get_devices()
+
+    def invalidate(self, device=None):
+        ''' Forget what is known about device, or about every device (e.g. when a new phase starts) '''
+        with self._lock:
+            if device is None:
+                self._devices = None
+            else:
+                self._stale.add(device)
+
+    def get(self, device):
+        ''' Returns {'UUID': ..., 'LABEL': ..., 'TYPE': ..., 'PARTUUID': ...} (keys may be missing) '''
+        node = self._get_devices().get(device)
+        return node.get_values() if node is not None else {}
+
+    def get_device(self, device):
+        ''' The BlockDevice of the path device, or None '''
+        return self._get_devices().get(device)
+
+    def devices(self):
+        ''' All the probed devices '''
+        return sorted(self._get_devices())
+
+    def disks(self):
+        ''' The BlockDevice of every disk '''
+        return [device for path, device in sorted(self._get_devices().items()) if device.type == 'disk']
+
+    def get_disk(self, device):
+        ''' The BlockDevice of the disk holding device (itself for a disk), or None '''
+        devices = self._get_devices()
+        node, seen = devices.get(device), set()
+        while node is not None and node.type != 'disk' and node.parents and node.path not in seen:
+            seen.add(node.path)
+            node = devices.get(node.parents[0])
+        return node if node is not None and node.type == 'disk' else None
+
+    def get_uuid(self, device):
+        return self.get(device).get('UUID')
+
+    def get_type(self, device):
+        return self.get(device).get('TYPE')
+
+    def find_label(self, label):
+        ''' Returns the devices whose filesystem is labelled label '''
+        return sorted(path for path, device in self._get_devices().items() if device.label == label)
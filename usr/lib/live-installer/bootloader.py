@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+import os
+import re
+import shlex
+
+# kinds of problem a new grub-mkconfig run can fix
+RETRIABLE = ('failed', 'missing', 'syntax')
+
+
+class GrubProblem(object):
+
+    def __init__(self, kind, message):
+        self.kind = kind
+        self.message = message
+
+    @property
+    def retriable(self):
+        return self.kind in RETRIABLE
+
+    def __str__(self):
+        return self.message
+
+
+class MenuEntry(object):
+
+    def __init__(self, title, line):
+        self.title = title
+        self.line = line
+        self.classes = []
+        self.linux = None
+        self.initrd = []
+
+
+def parse_menu_entries(text):
+    ''' Returns the MenuEntry of every menuentry of a grub.cfg (submenus included), and the number of blocks left open '''
+    entries, stack = [], []
+    for number, line in enumerate(text.splitlines(), 1):
+        try:
+            words = shlex.split(line, comments=True)
+        except ValueError:
+            words = line.split()
+        if not words:
+            continue
+        entry = None
+        if words[0] == 'menuentry':
+            entry = MenuEntry(words[1] if len(words) > 1 else '', number)
+            entry.classes = [words[i + 1] for i, word in enumerate(words[:-1]) if word == '--class']
+            entries.append(entry)
+        else:
+            current = [block for block in stack if block is not None]
+            if current and len(words) > 1 and words[0] in ('linux', 'linuxefi', 'linux16'):
+                current[-1].linux = words[1]
+            elif current and words[0] in ('initrd', 'initrdefi', 'initrd16'):
+                current[-1].initrd.extend(words[1:])
+        # braces are words of their own, ${var} is not
+        for word in words:
+            if word == '{':
+                stack.append(entry)
+            elif word == '}' and stack:
+                stack.pop()
+    return entries, len(stack)
+
+
+def is_own_entry(entry):
+    return 'gooroom' in entry.classes or 'Gooroom' in entry.title or 'Debian' in entry.title
+
+
+def check_grub_config(path, root='/target'):
+    ''' Checks the grub.cfg at path (on the target mounted at root) and returns the list of GrubProblem found '''
+    if not os.path.exists(path):
+        return [GrubProblem('missing', "%s was not generated" % path)]
+    with open(path, errors='replace') as f:
+        text = f.read()
+    if not text.strip():
+        return [GrubProblem('missing', "%s is empty" % path)]
+
+    problems = []
+    entries, depth = parse_menu_entries(text)
+    if depth != 0:
+        problems.append(GrubProblem('syntax', "%s is truncated or unbalanced (%d blocks left open)" % (path, depth)))
+    own = [entry for entry in entries if is_own_entry(entry)]
+    if not own:
+        problems.append(GrubProblem('entry', "%s has no Gooroom menu entry" % path))
+    for entry in own:
+        if entry.linux is None:
+            problems.append(GrubProblem('syntax', "The menu entry '%s' (line %d) has no kernel" % (entry.title, entry.line)))
+            continue
+        # the paths are relative to the partition holding /boot, which may be / or /boot
+        for image in [entry.linux] + entry.initrd:
+            image = re.sub(r'^\([^)]*\)', '', image)
+            candidates = [os.path.join(root, image.lstrip('/')), os.path.join(root, 'boot', image.lstrip('/'))]
+            if not any(os.path.exists(candidate) for candidate in candidates):
+                problems.append(GrubProblem('image', "The menu entry '%s' (line %d) boots the missing %s" % (entry.title, entry.line, image)))
+    return problems
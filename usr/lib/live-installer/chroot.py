@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+# Everything the worker needs is imported before it chroots, the host's
+# python modules are not reachable afterwards.
+import os
+import sys
+import json
+import time
+import signal
+import resource
+import threading
+import subprocess
+
+from commands import KILL_GRACE
+from timeline import exit_status
+
+
+class ChrootResult(object):
+
+    def __init__(self, argv, returncode, stdout, stderr, wall, timed_out=False, cancelled=False, rusage=None):
+        self.argv = argv
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.wall = wall
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+        self.rusage = rusage    # a resource.struct_rusage, like commands.CommandResult's
+
+    @property
+    def cpu_time(self):
+        if self.rusage is None:
+            return 0.0
+        return self.rusage.ru_utime + self.rusage.ru_stime
+
+
+class ChrootWorker(object):
+    ''' A long-lived process chrooted into the target, which runs the commands it is sent.
+
+    The commands are argv lists (no shell, no re-quoting) and each of them
+    gets back its exit code, stdout, stderr, wall time and resource usage.
+    The output is streamed back line by line while the command runs. Like
+    commands.run, a command is stopped with its process group when its timeout
+    has passed or when it is cancelled. Several commands may be in flight at
+    once, from different threads, and run concurrently. The worker chroots
+    once, so running a command costs a single fork/exec.
+
+    Use as:
+
+        worker = ChrootWorker("/target")
+        worker.start()
+        result = worker.run(["update-grub"], log=print)
+        worker.stop()  # before unmounting /target
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.process = None
+        self._counter = 0
+        self._results = {}
+        self._output = {}
+        self._logs = {}
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+
+    def start(self):
+        print(" --> Starting the chroot worker in %s" % self.root)
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), self.root],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        universal_newlines=True, bufsize=1)
+        reader = threading.Thread(target=self._read, name="chroot worker")
+        reader.daemon = True
+        reader.start()
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def _read(self):
+        for line in self.process.stdout:
+            try:
+                response = json.loads(line)
+            except ValueError:
+                continue
+            if 'line' in response:
+                # a line of output of a running command
+                with self._lock:
+                    output = self._output.get(response['id'])
+                    if output is not None:
+                        output[response['stream']].append(response['line'])
+                    log = self._logs.get(response['id'])
+                if log is not None:
+                    log(response['line'].rstrip("\n"))
+                continue
+            with self._lock:
+                self._results[response['id']] = response
+                self._done.notify_all()
+        self.process.wait()
+        with self._lock:
+            self._done.notify_all()
+
+    def _send(self, request):
+        self.process.stdin.write(json.dumps(request) + '\n')
+        self.process.stdin.flush()
+
+    def submit(self, argv, env=None, input=None, timeout=None, log=None):
+        ''' Send argv to the worker, returns the request id to wait() on.
+        log(line) gets the lines of output (stdout and stderr) as they come. '''
+        with self._lock:
+            if not self.is_running():
+                raise Exception("The chroot worker in %s is not running" % self.root)
+            self._counter += 1
+            self._output[self._counter] = {'stdout': [], 'stderr': []}
+            if log is not None:
+                self._logs[self._counter] = log
+            self._send({'id': self._counter, 'argv': list(argv), 'env': env or {}, 'input': input, 'timeout': timeout})
+            return self._counter
+
+    def wait(self, request_id, cancel=None):
+        ''' Waits for the result of request_id, stopping the command when cancel (a commands.Cancellation) is set '''
+        cancelled = False
+        with self._lock:
+            while request_id not in self._results:
+                if self.process.poll() is not None:
+                    raise Exception("The chroot worker in %s exited with %d" % (self.root, self.process.returncode))
+                if cancel is not None and cancel.is_set() and not cancelled:
+                    cancelled = True
+                    self._send({'cancel': request_id})
+                self._done.wait(0.1 if cancel is not None else 1)
+            response = self._results.pop(request_id)
+            output = self._output.pop(request_id)
+            self._logs.pop(request_id, None)
+        rusage = response.get('rusage')
+        return ChrootResult(response['argv'], response['returncode'], ''.join(output['stdout']),
+                            ''.join(output['stderr']), response['wall'], response.get('timed_out', False),
+                            response.get('cancelled', False), resource.struct_rusage(rusage) if rusage else None)
+
+    def run(self, argv, env=None, input=None, timeout=None, cancel=None, log=None):
+        return self.wait(self.submit(argv, env, input, timeout, log), cancel)
+
+    def run_batch(self, commands, env=None, cancel=None):
+        ''' Run the argv lists concurrently, returns their results in the same order '''
+        ids = [self.submit(argv, env) for argv in commands]
+        return [self.wait(request_id, cancel) for request_id in ids]
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            try:
+                self.process.wait(30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        print(" --> Stopped the chroot worker in %s" % self.root)
+        self.process = None
+
+
+def serve(root):
+    ''' The worker side: chroot into root and run the requests read from stdin '''
+    os.chroot(root)
+    os.chdir('/')
+    output = sys.stdout
+    output_lock = threading.Lock()
+    cancels = {}
+
+    def _write(message):
+        with output_lock:
+            output.write(json.dumps(message) + '\n')
+            output.flush()
+
+    def _stream(request_id, name, stream):
+        for line in stream:
+            _write({'id': request_id, 'stream': name, 'line': line})
+        stream.close()
+
+    def _feed(stdin, data):
+        try:
+            stdin.write(data)
+            stdin.close()
+        except OSError:
+            pass
+
+    def _signal(pid, sig):
+        try:
+            os.killpg(pid, sig)
+        except OSError:
+            pass
+
+    def _run(request, cancel):
+        start = time.monotonic()
+        env = dict(os.environ, **request['env'])
+        timeout = request['timeout']
+        timed_out = cancelled = False
+        rusage = None
+        try:
+            p = subprocess.Popen(request['argv'], env=env, stdin=subprocess.PIPE if request['input'] is not None else subprocess.DEVNULL,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, errors='replace',
+                                 start_new_session=True)
+        except OSError as detail:
+            _write({'id': request['id'], 'stream': 'stderr', 'line': str(detail)})
+            returncode = 127
+        else:
+            threads = [threading.Thread(target=_stream, args=(request['id'], 'stdout', p.stdout)),
+                       threading.Thread(target=_stream, args=(request['id'], 'stderr', p.stderr))]
+            if request['input'] is not None:
+                threads.append(threading.Thread(target=_feed, args=(p.stdin, request['input'])))
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            # the same stop sequence as commands.run: SIGTERM to the group, SIGKILL after KILL_GRACE
+            stop_time = None
+            delay = 0.005
+            while True:
+                pid, status, rusage = os.wait4(p.pid, os.WNOHANG)
+                if pid != 0:
+                    break
+                now = time.monotonic()
+                if stop_time is None:
+                    if timeout is not None and now - start > timeout:
+                        timed_out = True
+                    elif cancel.is_set():
+                        cancelled = True
+                    if timed_out or cancelled:
+                        stop_time = now
+                        _signal(p.pid, signal.SIGTERM)
+                elif now - stop_time > KILL_GRACE:
+                    # grub-install & co. leave children behind, stop the whole group
+                    _signal(p.pid, signal.SIGKILL)
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+            returncode = p.returncode = exit_status(status)
+            for thread in threads:
+                thread.join(1)
+            if timed_out:
+                _write({'id': request['id'], 'stream': 'stderr', 'line': "Timed out after %s seconds\n" % timeout})
+        with output_lock:
+            cancels.pop(request['id'], None)
+        _write({'id': request['id'], 'argv': request['argv'], 'returncode': returncode, 'wall': time.monotonic() - start,
+                'timed_out': timed_out, 'cancelled': cancelled, 'rusage': list(rusage) if rusage is not None else None})
+
+    threads = []
+    for line in sys.stdin:
+        request = json.loads(line)
+        if 'cancel' in request:
+            with output_lock:
+                cancel = cancels.get(request['cancel'])
+            if cancel is not None:
+                cancel.set()
+            continue
+        cancel = threading.Event()
+        with output_lock:
+            cancels[request['id']] = cancel
+        thread = threading.Thread(target=_run, args=(request, cancel))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1])
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+import os
+import time
+import signal
+import threading
+import subprocess
+from collections import deque
+
+from timeline import exit_status
+
+# How long a command gets to exit after SIGTERM before it is killed
+KILL_GRACE = 5
+# How many lines of output a failed command reports
+KEEP_LINES = 50
+
+
+class CommandError(Exception):
+    ''' A command failed, timed out or was cancelled, result holds what is known about it '''
+
+    def __init__(self, result):
+        self.result = result
+        Exception.__init__(self, result.describe())
+
+
+class CommandCancelled(CommandError):
+    pass
+
+
+class Cancellation(object):
+    ''' Cooperative cancellation shared by the commands of an installation '''
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason="cancelled"):
+        self.reason = reason
+        self._event.set()
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def check(self):
+        ''' Raise CommandCancelled if cancelled, for the steps between two commands '''
+        if self.is_set():
+            raise CommandCancelled(CommandResult([], None, [], 0.0, None, cancelled=True))
+
+
+class CommandResult(object):
+
+    def __init__(self, argv, returncode, lines, duration, rusage, timed_out=False, cancelled=False, output=None):
+        self.argv = argv
+        self.returncode = returncode
+        self.lines = lines          # the last KEEP_LINES lines of output
+        self.output = output        # all the output, only when it was asked for
+        self.duration = duration
+        self.rusage = rusage
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+
+    @property
+    def cpu_time(self):
+        if self.rusage is None:
+            return 0.0
+        return self.rusage.ru_utime + self.rusage.ru_stime
+
+    def describe(self):
+        cmdline = " ".join(self.argv) or "the installation"
+        if self.cancelled:
+            reason = "was cancelled"
+        elif self.timed_out:
+            reason = "timed out after %.0fs" % self.duration
+        else:
+            reason = "exited with %s after %.1fs" % (self.returncode, self.duration)
+        last = (": " + self.lines[-1]) if self.lines else ""
+        return "'%s' %s%s" % (cmdline, reason, last)
+
+
+def run(argv, timeout=None, cancel=None, check=False, capture=False, env=None, cwd=None, log=print, prefix="    ",
+        stderr=subprocess.STDOUT):
+    ''' Runs argv (no shell) and returns a CommandResult.
+
+    The output (stdout and stderr) is streamed to log line by line as it comes,
+    only the last KEEP_LINES lines are kept unless capture is set. The command
+    is stopped, with its whole process group, when timeout seconds have passed
+    or cancel (a Cancellation) is set. With check, anything but a zero exit
+    status raises CommandError; a cancelled command always raises CommandCancelled.
+    stderr=subprocess.DEVNULL leaves the errors out of output that gets parsed. '''
+    argv = [str(arg) for arg in argv]
+    if cancel is not None:
+        cancel.check()
+    start = time.monotonic()
+    try:
+        p = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr,
+                             env=None if env is None else dict(os.environ, **env), cwd=cwd,
+                             universal_newlines=True, errors='replace', start_new_session=True)
+    except OSError as detail:
+        result = CommandResult(argv, 127, [str(detail)], 0.0, None)
+        if check:
+            raise CommandError(result)
+        return result
+
+    lines = deque(maxlen=KEEP_LINES)
+    output = [] if capture else None
+
+    def _read():
+        for line in p.stdout:
+            line = line.rstrip("\n")
+            lines.append(line)
+            if output is not None:
+                output.append(line)
+            if log is not None and line.strip("\0 "):
+                log(prefix + line)
+        p.stdout.close()
+
+    reader = threading.Thread(target=_read, name="output of %s" % argv[0])
+    reader.daemon = True
+    reader.start()
+
+    timed_out = cancelled = False
+    stop_time = None
+    delay = 0.005
+    while True:
+        pid, status, rusage = os.wait4(p.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        now = time.monotonic()
+        if stop_time is None:
+            if timeout is not None and now - start > timeout:
+                timed_out = True
+            elif cancel is not None and cancel.is_set():
+                cancelled = True
+            if timed_out or cancelled:
+                stop_time = now
+                _signal(p.pid, signal.SIGTERM)
+        elif now - stop_time > KILL_GRACE:
+            _signal(p.pid, signal.SIGKILL)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+    # tell Popen the process is reaped
+    p.returncode = exit_status(status)
+    # a daemon it started may still hold the pipe (it should not), don't wait for it
+    reader.join(1)
+
+    result = CommandResult(argv, p.returncode, list(lines), time.monotonic() - start, rusage,
+                           timed_out=timed_out, cancelled=cancelled, output=output)
+    if cancelled:
+        raise CommandCancelled(result)
+    if check and (timed_out or result.returncode != 0):
+        raise CommandError(result)
+    return result
+
+
+def _signal(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except OSError:
+        pass
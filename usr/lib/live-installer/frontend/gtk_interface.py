@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 from installer import InstallerEngine, Setup, NON_LATIN_KB_LAYOUTS
+from progress import PROGRESS_FPS
 from slideshow import Slideshow
 from dialogs import MessageDialog, QuestionDialog, ErrorDialog, WarningDialog
 import timezones
@@ -398,6 +399,8 @@ class InstallerWindow:
 
     def quit_cb(self, widget, data=None):
         if QuestionDialog(_("Quit"), _("Are you sure you want to quit the installer?")):
+            # stop the command the installation may be running
+            self.installer.cancel()
             Gtk.main_quit()
             return False
         else:
@@ -749,6 +752,9 @@ class InstallerWindow:
                 self.activate_page(self.PAGE_PARTITIONS)
             elif(sel == self.PAGE_PARTITIONS):
                 model = self.builder.get_object("treeview_disks").get_model()
+                if not model.done:
+                    # the disks are still being scanned
+                    return
 
                 # Check for root partition
                 found_root_partition = False
@@ -807,6 +813,8 @@ class InstallerWindow:
                 self.builder.get_object("button_next").set_label(_("Next"))
                 self.activate_page(self.PAGE_PARTITIONS)
             elif(sel == self.PAGE_PARTITIONS):
+                # Next is off while the disks are scanned
+                self.builder.get_object("button_next").set_sensitive(True)
                 #to prevent duplication of partition
                 found_root_partition = False
                 for partition in self.setup.partitions:
@@ -879,7 +887,9 @@ class InstallerWindow:
             Gtk.main_quit()
             sys.exit(0)
 
-        inst.set_progress_hook(self.update_progress)
+        # the engine only publishes its progress, redraw it at a fixed rate
+        self.progress_seq = 0
+        GObject.timeout_add(int(1000 / PROGRESS_FPS), self.poll_progress)
         inst.set_error_hook(self.error_message)
 
         # do we dare? ..
@@ -910,7 +920,9 @@ class InstallerWindow:
                 inst.finish_install(self.setup)
             except Exception as detail1:
                 print(detail1)
-                self.show_error_dialog(_("Installation error"), str(detail1))
+                # the progress never gets to done, the last dialog shows the error
+                self.error_message(message=str(detail1))
+                self.done = True
 
             # show a message dialog thingum
             while(not self.done):
@@ -934,7 +946,13 @@ class InstallerWindow:
         self.critical_error_happened = True
         self.critical_error_message = message
 
-    @idle
+    def poll_progress(self):
+        seq, update = self.installer.progress.get()
+        if seq != self.progress_seq:
+            self.progress_seq = seq
+            self.update_progress(*update)
+        return not self.done
+
     def update_progress(self, current, total, pulse, done, message):
         if(pulse):
             self.builder.get_object("label_install_progress").set_label(message)
@@ -0,0 +1,29 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+import os
+import hashlib
+
+# written in the target's initramfs-tools configuration for the compressor
+COMPRESS_CONF = 'etc/initramfs-tools/conf.d/live-installer-compress'
+
+
+def write_compress_conf(root, compress):
+    ''' Makes initramfs-tools use compress (i.e. zstd, which mkinitramfs runs multi-threaded) '''
+    path = os.path.join(root, COMPRESS_CONF)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write("# Written by live-installer\nCOMPRESS=%s\n" % compress)
+
+
+def write_checksum(root, version):
+    ''' Records the image like update-initramfs does, so that later updates of the installed system accept it '''
+    image = "/boot/initrd.img-%s" % version
+    digest = hashlib.sha1()
+    with open(os.path.join(root, image.lstrip('/')), 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    statedir = os.path.join(root, 'var/lib/initramfs-tools')
+    os.makedirs(statedir, exist_ok=True)
+    with open(os.path.join(statedir, version), 'w') as f:
+        f.write("%s  %s\n" % (digest.hexdigest(), image))
@@ -1,16 +1,45 @@
 import os
 import re
-import subprocess
-import time
+import glob
 import shutil
 import gettext
 import sys
 import parted
 import io
+import threading
+
+from progress import ProgressSlot
+from blockdev import BlockDeviceCache
+from packages import PackageTransaction
+from chroot import ChrootWorker
+from commands import Cancellation, CommandError, CommandCancelled
+from bootloader import GrubProblem, check_grub_config
+from osprober import OSProberCache
+import initramfs
+import locales
+import recovery
+import commands
+from timeline import InstallTimeline
+from scheduler import StepScheduler
+from journal import InstallJournal, get_fingerprint, JOURNAL_FILE, TARGET_JOURNAL_FILE
+from transfer import FileTransfer, SquashfsExtract, ImageDeploy, Manifest, TransferProgress, EXCLUDE_DIRS, top_entries
 
 gettext.install("live-installer", "/usr/share/gooroom/locale")
 
 CONFIG_FILE = '/etc/live-installer/live-installer.conf'
+MANIFEST_CACHE = '/tmp/live-installer/filesystem.files'
+JOURNAL_PROBE_MOUNTPOINT = '/tmp/live-installer/journalmount'
+
+# Timeouts (in seconds) of the commands which hang on bad media or hardware
+MOUNT_TIMEOUT = 120
+LABEL_TIMEOUT = 60
+GRUB_INSTALL_TIMEOUT = 600
+# grub-mkconfig runs os-prober, which mounts every other partition
+GRUB_MKCONFIG_TIMEOUT = 900
+ARCHIVE_TIMEOUT = 4 * 3600
+
+# How many times grub-mkconfig runs again when its result is broken in a way another run can fix
+GRUB_RETRIES = 2
 
 NON_LATIN_KB_LAYOUTS = ['am', 'af', 'ara', 'ben', 'bd', 'bg', 'bn', 'bt', 'by', 'deva', 'et', 'ge', 'gh', 'gn', 'gr', 'guj', 'guru', 'id', 'il', 'iku', 'in', 'iq', 'ir', 'kan', 'kg', 'kh', 'kz', 'la', 'lao', 'lk', 'ma', 'mk', 'mm', 'mn', 'mv', 'mal', 'my', 'np', 'ori', 'pk', 'ru', 'rs', 'scc', 'sy', 'syr', 'tel', 'th', 'tj', 'tam', 'tz', 'ua', 'uz']
 
@@ -44,6 +73,24 @@ class InstallerEngine:
         self.live_user = config.get('live_user', 'user')
         self.media = config.get('live_media_source', '/run/live/medium/live/filesystem.squashfs')
         self.media_type = config.get('live_media_type', 'squashfs')
+        self.media_manifest = config.get('live_media_manifest', os.path.splitext(self.media)[0] + '.files')
+        self.deploy_mode = config.get('deploy_mode', 'files')
+        self.deploy_image = config.get('deploy_image', '/run/live/medium/live/filesystem.img')
+        self.format_jobs_per_disk = int(config.get('format_jobs_per_disk', 2))
+        self.transfer_method = config.get('transfer_method', 'rsync')
+        self.transfer_workers = int(config.get('transfer_workers', 0))
+        self.initramfs_compress = config.get('initramfs_compress', '')
+        self.archive_compress_level = config.get('archive_compress_level', '')
+        self.archive_threads = int(config.get('archive_threads', 0) or 0)
+        # the live kernel is the one copied to the target
+        self.kernel_version = os.uname().release
+        self.journal = InstallJournal()
+        self.progress = ProgressSlot()
+        self.timeline = InstallTimeline()
+        self.blockdevs = BlockDeviceCache()
+        self.packages = PackageTransaction()
+        self.chroot = ChrootWorker("/target")
+        self.cancellation = Cancellation()
         # Flush print when it's called
         try:
             sys.stdout = io.TextIOWrapper(open(sys.stdout.fileno(), 'wb', 0), write_through=True)
@@ -52,9 +99,17 @@ class InstallerEngine:
 
     def set_progress_hook(self, progresshook):
         ''' Set a callback to be called on progress updates '''
-        ''' i.e. def my_callback(progress_type, message, current_progress, total) '''
-        ''' Where progress_type is any off PROGRESS_START, PROGRESS_UPDATE, PROGRESS_COMPLETE, PROGRESS_ERROR '''
-        self.update_progress = progresshook
+        ''' i.e. def my_callback(current, total, pulse, done, message) '''
+        ''' Updates are coalesced, frontends running a main loop should rather poll self.progress '''
+        self.progress.set_hook(progresshook)
+
+    def update_progress(self, current, total, pulse, done, message):
+        self.progress.publish(current, total, pulse, done, message)
+
+    def cancel(self):
+        ''' Stop the installation: the running command is stopped and the next ones are not started '''
+        print(" --> Cancelling the installation")
+        self.cancellation.cancel()
 
     def set_error_hook(self, errorhook):
         ''' Set a callback to be called on errors '''
@@ -67,66 +122,137 @@ class InstallerEngine:
         return self.distribution_version
 
     def step_format_partitions(self, setup):
-        for partition in setup.partitions:
-            if(partition.format_as is not None and partition.format_as != ""):
-                # report it. should grab the total count of filesystems to be formatted ..
-                self.update_progress(1, 4, True, False, _("Formatting %(partition)s as %(format)s ...") % {'partition':partition.path, 'format':partition.format_as})
-
-                #Format it
-                if partition.format_as == "swap":
-                    cmd = "mkswap %s" % partition.path
-                else:
-                    if (partition.format_as in ['ext2', 'ext3', 'ext4']):
-                        cmd = "mkfs.%s -F %s" % (partition.format_as, partition.path)
-                    elif (partition.format_as == "jfs"):
-                        cmd = "mkfs.%s -q %s" % (partition.format_as, partition.path)
-                    elif (partition.format_as in ["btrfs", "xfs"]):
-                        cmd = "mkfs.%s -f %s" % (partition.format_as, partition.path)
-                    elif (partition.format_as == "vfat"):
-                        cmd = "mkfs.%s %s -F 32" % (partition.format_as, partition.path)
-                    else:
-                        cmd = "mkfs.%s %s" % (partition.format_as, partition.path) # works with bfs, minix, msdos, ntfs, vfat
-
-                self.do_unmount(partition.partition.path)
-                print("EXECUTING: '%s'" % cmd)
-                self.exec_cmd(cmd)
-                partition.type = partition.format_as
-
-            #
-            # Assign LABEL
-            #
-            def init_label(label_name):
-                cmd = "blkid | grep %s | awk -F':' '{print $1}'"% (label_name)
-                p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                        stderr=subprocess.STDOUT, universal_newlines=True)
-                for output in p.stdout.readlines():
-                    print("tune2fs -L '' %s" % output)
-                    os.system("tune2fs -L '' %s" % output)
-
-            if(partition.mount_as == "/"):
-                print("==== DEBUG ==== Assign GRM_ROOT_VOL label to the %s partition" % (partition.partition.path))
-                init_label("GRM_ROOT_VOL")
-                os.system("tune2fs -L GRM_ROOT_VOL " + partition.partition.path)
+        ''' Format (and label) the partitions concurrently, at most format_jobs_per_disk at a time on each disk '''
+        jobs = [p for p in setup.partitions if p.mount_as in ("/", "/recovery", "/boot/efi") or
+                (p.format_as is not None and p.format_as != "")]
+        if not jobs:
+            return
+        # probe every device once, before any of them changes
+        self.blockdevs.probe()
+        # only the new filesystems lose their old label anyway, "/" and "/boot/efi" may be kept as they are
+        formatting = set(p.path for p in jobs if (p.format_as is not None and p.format_as != "") or
+                         (self.deploy_mode == "image" and p.mount_as == "/"))
+        disks = {}
+        for partition in jobs:
+            disks.setdefault(partition.partition.disk.device.path, threading.Semaphore(self.format_jobs_per_disk))
+        lock = threading.Lock()
+        finished = []
+        errors = []
+
+        def _format_job(partition):
+            with disks[partition.partition.disk.device.path]:
+                try:
+                    if(self.deploy_mode == "image" and partition.mount_as == "/"):
+                        # the image replaces both the mkfs and the file copy
+                        self.step_deploy_image(partition)
+                    elif(partition.format_as is not None and partition.format_as != ""):
+                        self.update_progress(len(finished), len(jobs), False, False, _("Formatting %(partition)s as %(format)s ...") % {'partition':partition.path, 'format':partition.format_as})
+                        self.do_format_partition(partition)
+                    # the label goes on the new filesystem, right after its own mkfs
+                    self.do_label_partition(partition, formatting)
+                except Exception as detail:
+                    print("Formatting %s failed: %s" % (partition.path, detail))
+                    with lock:
+                        errors.append("%s: %s" % (partition.path, detail))
+                with lock:
+                    finished.append(partition)
+                    if partition.format_as:
+                        self.update_progress(len(finished), len(jobs), False, False, _("Formatting %(partition)s as %(format)s ...") % {'partition':partition.path, 'format':partition.format_as})
+
+        threads = []
+        for partition in jobs:
+            thread = threading.Thread(target=_format_job, args=(partition,), name="format %s" % partition.path)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise Exception(_("Could not format the partitions:") + "\n" + "\n".join(errors))
+
+    def do_format_partition(self, partition):
+        #Format it
+        if partition.format_as == "swap":
+            cmd = ["mkswap", partition.path]
+        else:
+            if (partition.format_as in ['ext2', 'ext3', 'ext4']):
+                cmd = ["mkfs.%s" % partition.format_as, "-F", partition.path]
+            elif (partition.format_as == "jfs"):
+                cmd = ["mkfs.%s" % partition.format_as, "-q", partition.path]
+            elif (partition.format_as in ["btrfs", "xfs"]):
+                cmd = ["mkfs.%s" % partition.format_as, "-f", partition.path]
+            elif (partition.format_as == "vfat"):
+                cmd = ["mkfs.%s" % partition.format_as, partition.path, "-F", "32"]
+            else:
+                cmd = ["mkfs.%s" % partition.format_as, partition.path] # works with bfs, minix, msdos, ntfs, vfat
 
-            if(partition.mount_as == "/recovery"):
-                print("==== DEBUG ==== Assign GRM_RECOVERY label to the %s partition" % (partition.partition.path))
-                init_label("GRM_RECOVERY")
-                os.system("tune2fs -L GRM_RECOVERY " + partition.partition.path)
+        self.do_unmount(partition.partition.path)
+        try:
+            with self.timeline.step("mkfs %s" % partition.path, "mkfs", format=partition.format_as):
+                self.run_command(cmd, check=True)
+        finally:
+            self.blockdevs.invalidate(partition.path)
+        partition.type = partition.format_as
 
-            if(partition.mount_as == "/boot/efi"):
-                print("==== DEBUG ==== Assign GRM_BOOTEFI label to the %s partition" % (partition.partition.path))
-                init_label("GRM_BOOTEFI")
-                os.system("fatlabel %s GRM_BOOTEFI" % partition.partition.path)
+    def do_label_partition(self, partition, formatting=()):
+        #
+        # Assign LABEL
+        #
+        def init_label(label_name):
+            # the partitions being formatted (maybe right now, by another job) lose their old label anyway
+            for device in self.blockdevs.find_label(label_name):
+                if device in formatting or device == partition.path:
+                    continue
+                self.run_command(["tune2fs", "-L", "", device], timeout=LABEL_TIMEOUT)
+                self.blockdevs.invalidate(device)
+
+        if(partition.mount_as == "/"):
+            print("==== DEBUG ==== Assign GRM_ROOT_VOL label to the %s partition" % (partition.partition.path))
+            init_label("GRM_ROOT_VOL")
+            self.run_command(["tune2fs", "-L", "GRM_ROOT_VOL", partition.partition.path], timeout=LABEL_TIMEOUT)
+            self.blockdevs.invalidate(partition.path)
+
+        if(partition.mount_as == "/recovery"):
+            print("==== DEBUG ==== Assign GRM_RECOVERY label to the %s partition" % (partition.partition.path))
+            init_label("GRM_RECOVERY")
+            self.run_command(["tune2fs", "-L", "GRM_RECOVERY", partition.partition.path], timeout=LABEL_TIMEOUT)
+            self.blockdevs.invalidate(partition.path)
+
+        if(partition.mount_as == "/boot/efi"):
+            print("==== DEBUG ==== Assign GRM_BOOTEFI label to the %s partition" % (partition.partition.path))
+            init_label("GRM_BOOTEFI")
+            self.run_command(["fatlabel", partition.partition.path, "GRM_BOOTEFI"], timeout=LABEL_TIMEOUT)
+            self.blockdevs.invalidate(partition.path)
+
+    def step_deploy_image(self, partition):
+        print(" --> Deploying %s on %s" % (self.deploy_image, partition.path))
+        if(not os.path.exists(self.deploy_image)):
+            raise Exception(_("ERROR: The root filesystem image %s was not found on the installation medium!") % self.deploy_image)
+        self.do_unmount(partition.partition.path)
+        deploy = ImageDeploy(self.deploy_image, partition.path)
+        deploy.set_progress_hook(lambda percent, message: self.update_progress(percent, 100, False, False, message))
+        result = deploy.run(self.cancellation)
+        # the image brings its own filesystem, with a new UUID
+        self.blockdevs.invalidate(partition.path)
+        if result != 0:
+            raise Exception(_("Could not write %(image)s to %(partition)s") % {'image': self.deploy_image, 'partition': partition.path})
+        partition.format_as = "ext4"
+        partition.type = "ext4"
 
     def step_mount_source(self, setup):
         # Mount the installation media
         print(" --> Mounting partitions")
+        if self.media_type == "unsquashfs":
+            # extracted straight into /target by step_transfer_files
+            print(" ------ %s will be extracted directly, not mounted" % self.media)
+            return
         self.update_progress(2, 4, False, False, _("Mounting %(partition)s on %(mountpoint)s") % {'partition':self.media, 'mountpoint':"/source/"})
         print(" ------ Mounting %s on %s" % (self.media, "/source/"))
         self.do_mount(self.media, "/source/", self.media_type, options="loop")
 
     def step_mount_partitions(self, setup):
-        self.step_mount_source(setup)
+        if self.deploy_mode != "image":
+            self.step_mount_source(setup)
 
         # Mount the target partition
         for partition in setup.partitions:
@@ -145,13 +271,50 @@ class InstallerEngine:
         for partition in setup.partitions:
             if(partition.mount_as is not None and partition.mount_as != "" and partition.mount_as != "/" and partition.mount_as != "swap"):
                 print(" ------ Mounting %s on %s" % (partition.path, "/target" + partition.mount_as))
-                os.system("mkdir -p /target" + partition.mount_as)
+                os.makedirs("/target" + partition.mount_as, exist_ok=True)
                 if partition.type == "fat16" or partition.type == "fat32":
                     fs = "vfat"
                 else:
                     fs = partition.type
                 self.do_mount(partition.path, "/target" + partition.mount_as, fs, None)
 
+    def run_step(self, name, func, *args):
+        ''' Run one journaled installation step, unless a resumed installation already did it.
+        A step returning False went wrong without breaking the installation, it is not checkpointed. '''
+        if self.journal.is_done(name):
+            print(" --> Skipping '%s', already done by a previous installation attempt" % name)
+            return
+        try:
+            with self.timeline.step(name, "step") as step:
+                complete = func(*args)
+                if complete is False:
+                    step.status = "incomplete"
+        except Exception:
+            # keep what was measured so far, the frontend aborts the installation
+            self.timeline.write()
+            raise
+        if complete is False:
+            print("WARNING: '%s' did not complete, a resumed installation runs it again" % name)
+            return
+        self.journal.mark_done(name)
+
+    def find_target_journal(self, setup):
+        ''' Returns the paths of the journals left on the target by an interrupted installation '''
+        if setup.skip_mount:
+            return (os.path.join("/target", TARGET_JOURNAL_FILE),)
+        for partition in setup.partitions:
+            if partition.mount_as == "/":
+                found = os.path.join(os.path.dirname(JOURNAL_FILE), "journal-target.json")
+                if os.path.exists(found):
+                    os.remove(found)
+                os.makedirs(JOURNAL_PROBE_MOUNTPOINT, exist_ok=True)
+                self.run_command(["mount", "-o", "ro", partition.path, JOURNAL_PROBE_MOUNTPOINT], timeout=MOUNT_TIMEOUT)
+                if os.path.exists(os.path.join(JOURNAL_PROBE_MOUNTPOINT, TARGET_JOURNAL_FILE)):
+                    self.run_command(["cp", "-f", os.path.join(JOURNAL_PROBE_MOUNTPOINT, TARGET_JOURNAL_FILE), found])
+                self.run_command(["umount", JOURNAL_PROBE_MOUNTPOINT], timeout=MOUNT_TIMEOUT)
+                return (found,)
+        return ()
+
     def init_install(self, setup):
         # mount the media location.
         print(" --> Installation started")
@@ -168,163 +331,194 @@ class InstallerEngine:
             self.error_message(message=_("ERROR: Something is wrong with the installation medium! This is usually caused by burning tools which are not compatible with LMDE (YUMI or other multiboot tools). Please burn the ISO image to DVD/USB using a different tool."))
             return
 
-        os.system("umount --force /target/sys/firmware/efi/efivars")
-        os.system("umount --force /target/dev/shm")
-        os.system("umount --force /target/dev/pts")
-        os.system("umount --force /target/dev/")
-        os.system("umount --force /target/sys/")
-        os.system("umount --force /target/proc/")
-        os.system("umount --force /target/run/")
-        os.system("umount --force /target/boot/efi")
-        os.system("umount --force /target/recovery")
+        for mountpoint in ["/target/sys/firmware/efi/efivars", "/target/dev/shm", "/target/dev/pts", "/target/dev/",
+                           "/target/sys/", "/target/proc/", "/target/run/", "/target/boot/efi", "/target/recovery"]:
+            self.run_command(["umount", "--force", mountpoint], timeout=MOUNT_TIMEOUT)
+
+        # resume an interrupted installation of the same setup, if any
+        candidates = () if os.path.exists(JOURNAL_FILE) else self.find_target_journal(setup)
+        self.journal.open(get_fingerprint(self, setup), candidates)
+        # devices may have changed since the partitioning screen, start with a fresh probe
+        self.blockdevs.invalidate()
 
         if (not setup.skip_mount):
-            self.step_format_partitions(setup)
+            self.run_step("format_partitions", self.step_format_partitions, setup)
             self.step_mount_partitions(setup)
         else:
             self.step_mount_source(setup)
+        self.journal.set_target("/target")
 
         # Transfer the files
-        SOURCE = "/source/"
-        DEST = "/target/"
-        EXCLUDE_DIRS = "home/* dev/* proc/* sys/* tmp/* run/* mnt/* media/* lost+found source target".split()
-        our_current = 0
-        # (Valid) assumption: num-of-files-to-copy ~= num-of-used-inodes-on-/
-        our_total = int(subprocess.check_output("df --inodes /{src} | awk 'END{{ print $3 }}'".format(src=SOURCE.strip('/')), shell=True, universal_newlines=True))
-        print(" --> Copying {} files".format(our_total))
-        rsync_filter = ' '.join('--exclude=' + SOURCE + d for d in EXCLUDE_DIRS)
-        rsync = subprocess.Popen("rsync --verbose --archive --no-D --acls "
-                                 "--hard-links --xattrs {rsync_filter} "
-                                 "{src}* {dst}".format(src=SOURCE, dst=DEST, rsync_filter=rsync_filter),
-                                 shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-        while rsync.poll() is None:
-            line = rsync.stdout.readline()
-            if not line:  # still copying the previous file, just wait
-                time.sleep(0.1)
-            else:
-                our_current = min(our_current + 1, our_total)
-                self.update_progress(our_current, our_total, False, False, _("Copying %s") % line.rstrip())
-        print("rsync exited with returncode: " + str(rsync.poll()))
+        if self.deploy_mode == "image" and not setup.skip_mount:
+            print(" --> Root filesystem deployed from %s, skipping the file copy" % self.deploy_image)
+        else:
+            self.step_transfer_files(setup)
+
+        self.step_enter_chroot(setup)
+
+        # dpkg runs update-initramfs triggers, so the kernel and initrd are copied first.
+        # The maintainer scripts write to /target/etc too, and the initramfs hooks read
+        # fstab: it is written before dpkg runs, not alongside.
+        steps = StepScheduler(self.run_step)
+        steps.add("copy_kernel", self.step_copy_kernel, setup)
+        steps.add("write_fstab", self.step_write_fstab, setup)
+        steps.add("install_packages", self.step_install_initial_packages, setup,
+                  requires=["copy_kernel", "write_fstab"], resources=["dpkg"])
+        if (setup.gptonefi):
+            steps.add("install_efi", self.step_install_efi, setup,
+                      requires=["install_packages"], resources=["dpkg"])
+
+        # Detect cdrom device
+        # TODO : properly detect cdrom device
+        # Mount it
+        # os.system("mkdir -p /target/media/cdrom")
+        # if (int(os.system("mount /dev/sr0 /target/media/cdrom"))):
+        #     print " --> Failed to mount CDROM. Install will fail"
+        # self.do_run_in_chroot("apt-cdrom -o Acquire::cdrom::AutoDetect=false -m add")
+
+        steps.add("remove_live_packages", self.step_remove_live_packages, setup,
+                  requires=["install_packages", "install_efi"])
+        steps.run()
+        self.timeline.write()
 
+    def step_enter_chroot(self, setup):
         # Steps:
         our_total = 11
         our_current = 0
         # chroot
         print(" --> Chrooting")
         self.update_progress(our_current, our_total, False, False, _("Entering the system ..."))
-        os.system("mount --bind /dev/ /target/dev/")
-        os.system("mount --bind /dev/shm /target/dev/shm")
-        os.system("mount --bind /dev/pts /target/dev/pts")
-        os.system("mount --bind /sys/ /target/sys/")
-        os.system("mount --bind /proc/ /target/proc/")
-        os.system("mount --bind /run/ /target/run/")
-        os.system("mv /target/etc/resolv.conf /target/etc/resolv.conf.bk")
-        os.system("cp -f /etc/resolv.conf /target/etc/resolv.conf")
+        for source, mountpoint in [("/dev/", "/target/dev/"), ("/dev/shm", "/target/dev/shm"), ("/dev/pts", "/target/dev/pts"),
+                                   ("/sys/", "/target/sys/"), ("/proc/", "/target/proc/"), ("/run/", "/target/run/")]:
+            self.run_command(["mount", "--bind", source, mountpoint], timeout=MOUNT_TIMEOUT)
+        if(not os.path.exists("/target/etc/resolv.conf.bk")):
+            self.run_command(["mv", "/target/etc/resolv.conf", "/target/etc/resolv.conf.bk"])
+        self.run_command(["cp", "-f", "/etc/resolv.conf", "/target/etc/resolv.conf"])
 
         if os.path.exists("/sys/firmware/efi/efivars"):
-            os.system("mkdir -p /target/sys/firmware/efi/efivars")
-            os.system("mount --bind /sys/firmware/efi/efivars /target/sys/firmware/efi/efivars")
+            os.makedirs("/target/sys/firmware/efi/efivars", exist_ok=True)
+            self.run_command(["mount", "--bind", "/sys/firmware/efi/efivars", "/target/sys/firmware/efi/efivars"], timeout=MOUNT_TIMEOUT)
 
-        kernelversion= subprocess.check_output("uname -r", shell=True, universal_newlines=True)
-        os.system("cp /run/live/medium/live/vmlinuz /target/boot/vmlinuz-%s" % kernelversion)
+        if not self.chroot.is_running():
+            self.chroot.start()
+
+        if self.journal.resumed:
+            # finish whatever dpkg was doing when the previous attempt was interrupted
+            self.do_run_in_chroot(["dpkg", "--configure", "-a"])
+
+    def step_copy_kernel(self, setup):
+        kernelversion = self.kernel_version
+        self.run_command(["cp", "/run/live/medium/live/vmlinuz", "/target/boot/vmlinuz-%s" % kernelversion], check=True)
         found_initrd = False
         for initrd in ["/run/live/medium/live/initrd.img", "/run/live/medium/live/initrd.lz"]:
             if os.path.exists(initrd):
-                os.system("cp %s /target/boot/initrd.img-%s" % (initrd, kernelversion))
+                self.run_command(["cp", initrd, "/target/boot/initrd.img-%s" % kernelversion], check=True)
                 found_initrd = True
                 break
 
         if not found_initrd:
             print("WARNING: No initrd found!!")
 
+    def queue_initial_setup(self, setup):
         ############# for gooroom-initial-setup #############
-        os.system("mkdir -p /target/debs")
-        os.system("cp /run/live/medium/pool/main/g/gooroom-initial-setup/gooroom-initial-setup* /target/debs/")
-        os.system("cp /run/live/medium/pool/main/g/gnome-online-accounts/* /target/debs/")
-        self.do_run_in_chroot("dpkg -i /debs/*.deb")
-        os.system("rm -rf /target/debs")
+        self.packages.install("gooroom-initial-setup*", source="gooroom-initial-setup")
+        self.packages.install("*", source="gnome-online-accounts")
         #####################################################
 
-        if (setup.gptonefi):
-            print(" --> Installing EFI packages and Adding EFI entry")
-            os.system("mkdir -p /target/boot/efi/EFI/debian")
-            os.system("cp /run/live/medium/EFI/boot/grubx64.efi /target/boot/efi/EFI/debian")
-            os.system("mkdir -p /target/debs")
-            os.system("cp /run/live/medium/pool/main/g/grub2/grub-efi* /target/debs/")
-            os.system("cp /run/live/medium/pool/main/e/efibootmgr/efibootmgr* /target/debs/")
-            os.system("cp /run/live/medium/pool/main/e/efivar/* /target/debs/")
-            os.system("cp /run/live/medium/pool/main/s/shim/* /target/debs/")
-            self.do_run_in_chroot("DEBIAN_FRONTEND=noninteractive dpkg -P grub-pc grub-pc-bin")
-            self.do_run_in_chroot("dpkg -i /debs/*.deb")
-
-            #if(not os.path.exists("/target/boot/efi/EFI/gooroom/grubx64.efi")):
-                #
-                # TODO : Check signed grubx64.efi file
-                #        - dell OptiPlex 7040
-                #        - target=x86_64-efi
-                #
-                #/partition.partition.path
-                #for partition in setup.partitions:
-                #    if (partition.format_as == "vfat"):
-                #        print "--> partition.partition.path => \"%s\"" % partition.partition.path
-                #        self.do_run_in_chroot("efibootmgr --create --disk /dev/sda --part 1 -w --label gooroom --loader '\EFI\gooroom\grubx64.efi'")
-                #        self.do_run_in_chroot("efibootmgr -c -d /dev/sda -p 1 -L 'Gooroom' -l '\EFI\gooroom\grubx64.efi'")
-            self.do_run_in_chroot("grub-install --bootloader-id=gooroom --removable")
-
-            os.system("rm -rf /target/debs")
+    def queue_efi_packages(self, setup):
+        self.packages.install("grub-efi*", source="grub2")
+        self.packages.install("efibootmgr*", source="efibootmgr")
+        self.packages.install("*", source="efivar")
+        self.packages.install("*", source="shim")
+        self.packages.purge("grub-pc", "grub-pc-bin")
 
-        # Detect cdrom device
-        # TODO : properly detect cdrom device
-        # Mount it
-        # os.system("mkdir -p /target/media/cdrom")
-        # if (int(os.system("mount /dev/sr0 /target/media/cdrom"))):
-        #     print " --> Failed to mount CDROM. Install will fail"
-        # self.do_run_in_chroot("apt-cdrom -o Acquire::cdrom::AutoDetect=false -m add")
+    def queue_remove_live_packages(self, setup):
+        with open("/run/live/medium/live/filesystem.packages-remove", "r") as fd:
+            self.packages.purge(*fd.read().split())
 
+    def step_install_initial_packages(self, setup):
+        ''' The packages go in with a single transaction. They are queued by the step itself,
+        a resumed installation which already did it must not commit them again later. '''
+        self.queue_initial_setup(setup)
+        if (setup.gptonefi):
+            self.queue_efi_packages(setup)
+        self.queue_remove_live_packages(setup)
+        self.step_install_packages(setup)
+
+    def step_install_final_packages(self, setup):
+        ''' The firmware, recovery and exe-protector packages, in a single transaction '''
+        if os.path.exists("/etc/gooroom/info"):
+            self.queue_firmware(setup)
+        self.queue_recovery_packages(setup)
+        if self.packages.pool.has_source("gooroom-exe-protector"):
+            self.packages.install("*", source="gooroom-exe-protector")
+        self.step_install_packages(setup)
+
+    def step_install_packages(self, setup):
+        ''' Install and purge all the queued packages at once '''
+        print(" --> Installing packages")
+        with self.timeline.step("packages", "dpkg", debs=len(self.packages.debs), purges=len(self.packages.purges)) as step:
+            step.status = self.packages.commit("/target", self.do_run_in_chroot)
+        if step.status != 0:
+            raise Exception(_("Could not install the packages (exit status %s)") % step.status)
+
+    def step_install_efi(self, setup):
+        print(" --> Installing EFI packages and Adding EFI entry")
+        os.makedirs("/target/boot/efi/EFI/debian", exist_ok=True)
+        self.run_command(["cp", "/run/live/medium/EFI/boot/grubx64.efi", "/target/boot/efi/EFI/debian"])
+
+        #if(not os.path.exists("/target/boot/efi/EFI/gooroom/grubx64.efi")):
+            #
+            # TODO : Check signed grubx64.efi file
+            #        - dell OptiPlex 7040
+            #        - target=x86_64-efi
+            #
+            #/partition.partition.path
+            #for partition in setup.partitions:
+            #    if (partition.format_as == "vfat"):
+            #        print "--> partition.partition.path => \"%s\"" % partition.partition.path
+            #        self.do_run_in_chroot("efibootmgr --create --disk /dev/sda --part 1 -w --label gooroom --loader '\EFI\gooroom\grubx64.efi'")
+            #        self.do_run_in_chroot("efibootmgr -c -d /dev/sda -p 1 -L 'Gooroom' -l '\EFI\gooroom\grubx64.efi'")
+        # the fallback boot path, the firmware still has the EFI entry without it
+        return self.do_run_in_chroot(["grub-install", "--bootloader-id=gooroom", "--removable"], timeout=GRUB_INSTALL_TIMEOUT) == 0
+
+    def step_remove_live_packages(self, setup):
+        our_total = 11
+        our_current = 1
         # remove live-packages (or w/e)
+        # the live packages were purged with the other packages, remove the leftovers
         print(" --> Removing live packages")
-        our_current += 1
         self.update_progress(our_current, our_total, False, False, _("Removing live configuration (packages)"))
-        with open("/run/live/medium/live/filesystem.packages-remove", "r") as fd:
-            line = fd.read().replace('\n', ' ')
-        self.do_run_in_chroot("apt remove --purge --yes %s" % line)
-
-        # remove live leftovers
-        self.do_run_in_chroot("rm -rf /etc/live")
-        self.do_run_in_chroot("rm -rf /run/live")
+        self.do_run_in_chroot(["rm", "-rf", "/etc/live"])
+        self.do_run_in_chroot(["rm", "-rf", "/run/live"])
 
         # Lock and delete root password
-        self.do_run_in_chroot("passwd -dl root")
+        self.do_run_in_chroot(["passwd", "-dl", "root"])
 
         # Set LightDM to show user list by default
-        self.do_run_in_chroot(r"sed -i -r 's/^#?(greeter-hide-users)\s*=.*/\1=false/' /etc/lightdm/lightdm.conf")
+        self.do_run_in_chroot(["sed", "-i", "-r", r"s/^#?(greeter-hide-users)\s*=.*/\1=false/", "/etc/lightdm/lightdm.conf"])
 
+    def step_write_fstab(self, setup):
+        our_total = 11
+        our_current = 2
         # write the /etc/fstab
         print(" --> Writing fstab")
-        our_current += 1
         self.update_progress(our_current, our_total, False, False, _("Writing filesystem mount information to /etc/fstab"))
         # make sure fstab has default /proc and /sys entries
         #
         # A bug in adding partition table to the fstab if the partition was mounted automatically
         #
         #if(not os.path.exists("/target/etc/fstab")):
-        os.system("echo \"#### Static Filesystem Table File\" > /target/etc/fstab")
-        fstab = open("/target/etc/fstab", "a")
+        fstab = open("/target/etc/fstab", "w")
+        fstab.write("#### Static Filesystem Table File\n")
         fstab.write("proc\t/proc\tproc\tdefaults\t0\t0\n")
         if(not setup.skip_mount):
             for partition in setup.partitions:
                 if (partition.mount_as is not None and partition.mount_as != "" and partition.mount_as != "None"):
                     partition_uuid = partition.path # If we can't find the UUID we use the path
-                    blkid = subprocess.check_output('blkid', shell=True, universal_newlines=True).split('\n')
-                    for blkid_line in blkid:
-                        blkid_elements = blkid_line.split(':')
-                        if blkid_elements[0] == partition.path:
-                            blkid_mini_elements = blkid_line.split()
-                            for blkid_mini_element in blkid_mini_elements:
-                                if "UUID=" in blkid_mini_element:
-                                    partition_uuid = blkid_mini_element.replace('"', '').strip()
-                                    break
-                            break
+                    uuid = self.blockdevs.get_uuid(partition.path)
+                    if uuid is not None:
+                        partition_uuid = "UUID=%s" % uuid
 
                     fstab.write("# %s\n" % (partition.path))
 
@@ -349,47 +543,208 @@ class InstallerEngine:
                         fstab.write("%s\t%s\t%s\t%s\t%s\t%s\n" % (partition_uuid, partition.mount_as, fs, fstab_mount_options, "0", fstab_fsck_option))
         fstab.close()
 
+    def get_manifest(self, source=None):
+        ''' Returns the Manifest of the files to copy: the one shipped with the media,
+        the one built earlier in this session or a new one built from source '''
+        for path in (self.media_manifest, MANIFEST_CACHE):
+            if os.path.exists(path):
+                try:
+                    manifest = Manifest.load(path)
+                    print(" ------ Loaded the manifest %s" % path)
+                    return manifest
+                except (IOError, ValueError) as detail:
+                    print("WARNING: Could not load the manifest %s: %s" % (path, detail))
+        if source is None:
+            return None
+        print(" ------ Building the manifest of %s" % source)
+        self.update_progress(0, 0, True, False, _("Preparing the file copy ..."))
+        manifest = Manifest.build(source, EXCLUDE_DIRS)
+        try:
+            os.makedirs(os.path.dirname(MANIFEST_CACHE), exist_ok=True)
+            manifest.save(MANIFEST_CACHE)
+        except IOError as detail:
+            print("WARNING: Could not save the manifest: %s" % detail)
+        return manifest
+
+    def step_transfer_files(self, setup):
+        if self.media_type == "unsquashfs" or self.transfer_method != "native":
+            self.run_step("transfer_files", self.do_transfer_files, setup)
+        else:
+            with self.timeline.step("transfer_files", "step"):
+                self.do_transfer_files(setup)
+
+    def do_transfer_files(self, setup):
+        SOURCE = "/source/"
+        DEST = "/target/"
+        if self.media_type == "unsquashfs":
+            extract = SquashfsExtract(self.media, DEST, EXCLUDE_DIRS, self.transfer_workers)
+            print(" --> Extracting %s with %d processors" % (self.media, extract.workers))
+            manifest = self.get_manifest()
+            if manifest is not None:
+                # unsquashfs only reports inodes, spread the bytes evenly over them
+                progress = TransferProgress(manifest)
+                def _extract_progress(current, total):
+                    bytes_done = manifest.bytes_total * current // max(total, 1)
+                    progress.set(current, bytes_done)
+                    self.update_progress(bytes_done, manifest.bytes_total, False, False, progress.get_message(self.media))
+                extract.set_progress_hook(_extract_progress)
+            else:
+                extract.set_progress_hook(lambda current, total: self.update_progress(current, total, False, False, _("Copying %s") % self.media))
+            if extract.run(self.cancellation) != 0:
+                raise Exception(_("Could not extract %s") % self.media)
+            self.timeline.add_bytes(os.path.getsize(self.media))
+            return
+        manifest = self.get_manifest(SOURCE)
+        progress = TransferProgress(manifest)
+        print(" --> Copying {} files, {} bytes".format(manifest.files_total, manifest.bytes_total))
+        if self.transfer_method == "native":
+            transfer = FileTransfer(SOURCE, DEST, EXCLUDE_DIRS, self.transfer_workers, skip_existing=self.journal.resumed)
+            print(" ------ Using the native transfer engine with %d workers" % transfer.workers)
+            def _transfer_progress(files_done, bytes_done, path):
+                progress.set(files_done, bytes_done)
+                self.update_progress(min(bytes_done, manifest.bytes_total), manifest.bytes_total, False, False, progress.get_message(path))
+            transfer.set_progress_hook(_transfer_progress)
+            # one checkpoint per top-level directory, files copied by an
+            # interrupted attempt inside a subtree are skipped by the quick check
+            def _transfer_entry(entry):
+                bytes_done, errors = transfer.bytes_done, len(transfer.errors)
+                transfer.run([entry])
+                self.timeline.add_bytes(transfer.bytes_done - bytes_done)
+                # not checkpointed, a resumed installation copies what is missing again
+                if len(transfer.errors) > errors:
+                    raise Exception(_("Could not copy %(count)d files to the target, the first one is %(path)s: %(error)s") % {
+                        'count': len(transfer.errors) - errors, 'path': transfer.errors[errors][0], 'error': transfer.errors[errors][1]})
+            for entry in top_entries(SOURCE):
+                self.run_step("transfer_files:" + entry, _transfer_entry, entry)
+            print("native transfer finished with %d errors" % len(transfer.errors))
+            self.timeline.add_bytes(transfer.bytes_done)
+            return
+        argv = ["rsync", "--verbose", "--archive", "--no-D", "--acls", "--hard-links", "--xattrs"]
+        argv += ["--exclude=" + SOURCE + d for d in EXCLUDE_DIRS]
+        # what the "{src}*" shell glob used to expand to
+        argv += [os.path.join(SOURCE, entry) for entry in top_entries(SOURCE)] + [DEST]
+
+        def _rsync_line(line):
+            # symlinks and hard links are listed as "path -> target" and "path => target"
+            path = line.strip().split(' -> ')[0].split(' => ')[0]
+            if progress.add(path):
+                self.update_progress(min(progress.bytes_done, manifest.bytes_total), manifest.bytes_total, False, False, progress.get_message(path))
+        result = self.run_command(argv, log=_rsync_line)
+        print("rsync exited with returncode: " + str(result.returncode))
+        self.timeline.add_bytes(progress.bytes_done)
+        self.timeline.set_status(result.returncode)
+        if result.returncode in (23, 24):
+            # some files could not be transferred (23) or vanished from the source (24), like "cp -a" went on before
+            print("WARNING: rsync could not copy some of the files, see the lines above")
+        elif result.returncode != 0:
+            raise Exception(_("Could not copy the files to the target (rsync exited with %d)") % result.returncode)
+
     def do_archive_partition(self, our_total, our_current, setup):
         archive_root_partition = None
         archive_bootefi_partition = None
         archive_recovery_partition = None
 
+        # the recovery partition may come before / in the list, find them all first
         for partition in setup.partitions:
             if(partition.mount_as == "/"):
-                print("==== DEBUG ==== Assign archive_root_partition to the %s partition" % (partition.partition.path))
-                archive_root_partition = partition.partition.path
+                archive_root_partition = partition
+            elif(partition.mount_as == "/boot/efi"):
+                archive_bootefi_partition = partition
+            elif(partition.mount_as == "/recovery"):
+                archive_recovery_partition = partition
 
-            if(partition.mount_as == "/boot/efi"):
-                print("==== DEBUG ==== Assign archive_boot_partition to the %s partition" % (partition.partition.path))
-                archive_bootefi_partition = partition.partition.path
-
-            if(partition.mount_as == "/recovery"):
-                print("==== DEBUG ==== Assign archive_recovery_partition to the %s partition" % (partition.partition.path))
-                archive_recovery_partition = partition.partition.path
-
-                print(" --> Supporting Gooroom RECOVERY Mode")
-                self.update_progress(our_current, our_total, False, False, _("Configuring Recovery Mode"))
-
-                self.do_mount(archive_recovery_partition, "/target", "ext4", None)
-            #os.system("mount %s /target/recovery" % archive_recovery_partition)
+        if archive_recovery_partition is None or archive_root_partition is None:
+            return
 
-                print("fsarchiver savefs /target/gooroom_root_partition.fsa %s" % (archive_root_partition))
-                os.system("fsarchiver savefs /target/gooroom_root_partition.fsa %s" % archive_root_partition)
+        print(" --> Supporting Gooroom RECOVERY Mode")
+        self.update_progress(0, 100, False, False, _("Configuring Recovery Mode"))
+        recovery_path = archive_recovery_partition.partition.path
+        self.do_mount(recovery_path, "/target", self.blockdevs.get_type(recovery_path) or "ext4", None)
+
+        # both filesystems are saved at once, the EFI one is small and is done early
+        archives = [(recovery.ROOT_ARCHIVE, archive_root_partition)]
+        if archive_bootefi_partition is not None:
+            archives.append((recovery.BOOTEFI_ARCHIVE, archive_bootefi_partition))
+        progress = recovery.ArchiveProgress(
+            dict((name, partition.raw_size) for name, partition in archives),
+            lambda percent: self.update_progress(int(percent), 100, False, False, _("Configuring Recovery Mode")))
+        threads = recovery.get_threads(self.archive_threads)
+        errors = []
+
+        def _archive(name, partition):
+            path = partition.partition.path
+            argv = recovery.savefs_argv(os.path.join("/target", name), path, self.archive_compress_level, threads)
+            try:
+                with self.timeline.step("fsarchiver %s" % path, "fsarchiver"):
+                    self.run_command(argv, timeout=ARCHIVE_TIMEOUT, check=True, log=progress.get_logger(name))
+            except Exception as detail:
+                errors.append(detail)
 
-                if archive_bootefi_partition is not None:
-                    print("fsarchiver savefs /target/gooroom_bootefi_partition.fsa %s" % (archive_bootefi_partition))
-                    os.system("fsarchiver savefs /target/gooroom_bootefi_partition.fsa %s" % archive_bootefi_partition)
+        workers = [threading.Thread(target=_archive, args=archive, name="fsarchiver %s" % archive[0]) for archive in archives]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
 
-                os.system("umount --force %s" % archive_recovery_partition)
+        self.run_command(["umount", "--force", recovery_path], timeout=MOUNT_TIMEOUT)
+        if errors:
+            raise errors[0]
 
     def finish_install(self, setup):
         # Steps:
         our_total = 12
-        our_current = 5
+        our_current = 11
+        self.blockdevs.invalidate()
+
+        # the packages go in with a single transaction, once grub is configured
+        exe_protector = self.packages.pool.has_source("gooroom-exe-protector")
+
+        # The system configuration files are independent from each other, they
+        # all have to be written before gooroom-adjust and grub. dpkg, apt and
+        # update-initramfs share the "dpkg" resource and never run concurrently.
+        steps = StepScheduler(self.run_step)
+        steps.add("write_hostname", self.step_write_hostname, setup)
+        steps.add("set_locale", self.step_set_locale, setup)
+        steps.add("set_timezone", self.step_set_timezone, setup)
+        steps.add("write_isoinfo", self.step_write_isoinfo, setup)
+        steps.add("set_keyboard", self.step_set_keyboard, setup)
+        configured = ["write_hostname", "set_locale", "set_timezone", "write_isoinfo", "set_keyboard"]
+        steps.add("adjust_os", self.step_adjust_os, setup, requires=configured)
+        if(setup.grub_device is not None):
+            steps.add("install_grub", self.step_install_grub, setup, requires=["adjust_os"])
+        # the recovery packages replace grub, which has to be installed first
+        steps.add("install_final_packages", self.step_install_final_packages, setup,
+                  requires=["adjust_os", "install_grub"], resources=["dpkg"])
+        if exe_protector:
+            # the file signatures cover everything installed before
+            steps.add("install_exe_protector", self.step_install_exe_protector, setup,
+                      requires=configured + ["adjust_os", "install_grub", "install_final_packages"], resources=["dpkg"])
+        else:
+            steps.add("update_initramfs", self.step_update_initramfs, setup,
+                      requires=["adjust_os", "install_final_packages"], resources=["dpkg"])
+        steps.add("copy_recovery_boot", self.step_copy_recovery_boot, setup,
+                  requires=["install_exe_protector", "update_initramfs"])
+        steps.add("clean_apt", self.step_clean_apt, setup,
+                  requires=[step.name for step in steps.steps], resources=["dpkg"])
+        steps.run()
+
+        # the installation is complete, do not leave the journal on the target
+        self.journal.detach_target()
+        self.step_unmount_partitions(setup)
 
+        ## Recovery Mode
+        self.run_step("archive_partition", self.do_archive_partition, our_total, our_current, setup)
+        self.journal.discard()
+
+        self.timeline.write()
+        self.update_progress(0, 0, False, True, _("Installation finished"))
+        print(" --> All done")
+
+    def step_write_hostname(self, setup):
+        our_total = 12
+        our_current = 6
         # write host+hostname infos
         print(" --> Writing hostname")
-        our_current += 1
         self.update_progress(our_current, our_total, False, False, _("Setting hostname"))
         hostnamefh = open("/target/etc/hostname", "w")
         hostnamefh.write("%s\n" % setup.hostname)
@@ -406,39 +761,60 @@ class InstallerEngine:
         hostsfh.write("ff02::3 ip6-allhosts\n")
         hostsfh.close()
 
+    def step_set_locale(self, setup):
+        our_total = 12
+        our_current = 7
         # set the locale
         print(" --> Setting the locale")
-        our_current += 1
         self.update_progress(our_current, our_total, False, False, _("Setting locale"))
-        os.system("echo \"%s.UTF-8 UTF-8\" >> /target/etc/locale.gen" % setup.language)
-        self.do_run_in_chroot("locale-gen")
-        os.system("echo \"\" > /target/etc/default/locale")
-        self.do_run_in_chroot("update-locale LANG=\"%s.UTF-8\"" % setup.language)
-        self.do_run_in_chroot("update-locale LANG=%s.UTF-8" % setup.language)
-
+        locale = "%s.UTF-8" % setup.language
+        complete = True
+        enabled = locales.enable_locale("/target/etc/locale.gen", locale, "UTF-8")
+        # the target has the live system's compiled locale archive, compile only what it lacks
+        result = self.chroot.run(["localedef", "--list-archive"])
+        archived = set(result.stdout.split()) if result.returncode == 0 else set()
+        if locales.normalize(locale) in archived:
+            print(" --> %s is already in the locale archive" % locale)
+        elif self.do_run_in_chroot(["localedef", "-i", setup.language, "-c", "-f", "UTF-8",
+                                    "-A", "/usr/share/locale/locale.alias", locale]) != 0:
+            complete = self.do_run_in_chroot(["locale-gen"]) == 0
+        # and drop what locale.gen does not ask for, like locale-gen would
+        extra = archived - set(locales.normalize(name) for name in enabled)
+        extra = [name for name in extra if not name.startswith(("C.", "POSIX"))]
+        if extra:
+            self.do_run_in_chroot(["localedef", "--delete-from-archive"] + sorted(extra))
+        with open("/target/etc/default/locale", "w") as f:
+            f.write("\n")
+        if self.do_run_in_chroot(["update-locale", "LANG=%s" % locale]) != 0:
+            complete = False
+        return complete
+
+    def step_set_timezone(self, setup):
         # set the timezone
         print(" --> Setting the timezone")
-        os.system("echo \"%s\" > /target/etc/timezone" % setup.timezone)
-        os.system("rm -f /target/etc/localtime")
-        os.system("ln -s /usr/share/zoneinfo/%s /target/etc/localtime" % setup.timezone)
-
-        if os.path.exists("/etc/gooroom/info"):
-            # NT500R3W-LD2A, NT340XAA-K201G
-            self.do_run_firmware_atheros("NT500R3W")
-            self.do_run_firmware_atheros("NT340XAA")
+        with open("/target/etc/timezone", "w") as f:
+            f.write("%s\n" % setup.timezone)
+        self.run_command(["ln", "-sf", "/usr/share/zoneinfo/%s" % setup.timezone, "/target/etc/localtime"])
 
-            # NT500R3W-LD2A, NT340XAA-K201G
-            self.do_run_firmware_atheros("NT500R3W")
-            self.do_run_firmware_atheros("NT340XAA")
+    def queue_firmware(self, setup):
+        # NT500R3W-LD2A, NT340XAA-K201G
+        self.do_run_firmware_atheros("NT500R3W")
+        self.do_run_firmware_atheros("NT340XAA")
 
+    def step_write_isoinfo(self, setup):
         # generate the iso info
         print(" --> Generating /target/etc/gooroom/.isoinfo")
-        os.system("echo \"#\n# DO NOT EDIT THIS FILE\n# It is automatically generated by live-installer\n#\" > /target/etc/gooroom/.isoinfo")
-        os.system("cat /lib/live/mount/medium/.disk/info >> /target/etc/gooroom/.isoinfo")
+        with open("/target/etc/gooroom/.isoinfo", "w") as isoinfo:
+            isoinfo.write("#\n# DO NOT EDIT THIS FILE\n# It is automatically generated by live-installer\n#\n")
+            if os.path.exists("/lib/live/mount/medium/.disk/info"):
+                with open("/lib/live/mount/medium/.disk/info") as info:
+                    isoinfo.write(info.read())
 
+    def step_set_keyboard(self, setup):
+        our_total = 12
+        our_current = 8
         # set the keyboard options..
         print(" --> Setting the keyboard")
-        our_current += 1
         self.update_progress(our_current, our_total, False, False, _("Setting keyboard options"))
         consolefh = open("/target/etc/default/console-setup", "r")
         newconsolefh = open("/target/etc/default/console-setup.new", "w")
@@ -454,8 +830,7 @@ class InstallerEngine:
                 newconsolefh.write("%s\n" % line)
         consolefh.close()
         newconsolefh.close()
-        self.do_run_in_chroot("rm /etc/default/console-setup")
-        self.do_run_in_chroot("mv /etc/default/console-setup.new /etc/default/console-setup")
+        complete = self.do_run_in_chroot(["mv", "-f", "/etc/default/console-setup.new", "/etc/default/console-setup"]) == 0
 
         consolefh = open("/target/etc/default/keyboard", "r")
         newconsolefh = open("/target/etc/default/keyboard.new", "w")
@@ -473,118 +848,147 @@ class InstallerEngine:
                 newconsolefh.write("%s\n" % line)
         consolefh.close()
         newconsolefh.close()
-        self.do_run_in_chroot("rm /etc/default/keyboard")
-        self.do_run_in_chroot("mv /etc/default/keyboard.new /etc/default/keyboard")
+        if self.do_run_in_chroot(["mv", "-f", "/etc/default/keyboard.new", "/etc/default/keyboard"]) != 0:
+            complete = False
+        return complete
 
+    def step_adjust_os(self, setup):
         # Perform OS adjustments (this is needed prior to installing grub)
         if os.path.exists("/target/usr/lib/gooroom/gooroomSystem/gooroom-adjust.py"):
-            self.do_run_in_chroot("/usr/lib/gooroom/gooroomSystem/gooroom-adjust.py")
+            return self.do_run_in_chroot(["/usr/lib/gooroom/gooroomSystem/gooroom-adjust.py"]) == 0
 
+    def step_install_grub(self, setup):
+        our_total = 12
+        our_current = 9
         # write MBR (grub)
         print(" --> Configuring Grub")
-        our_current += 1
-        if(setup.grub_device is not None):
-            self.update_progress(our_current, our_total, False, False, _("Installing bootloader"))
-            print(" --> Running grub-install")
-            self.do_run_in_chroot("grub-install --force %s --recheck" % setup.grub_device)
-            #fix not add windows grub entry
-            self.do_run_in_chroot("update-grub")
-            self.do_configure_grub(our_total, our_current)
+        self.update_progress(our_current, our_total, False, False, _("Installing bootloader"))
+        print(" --> Running grub-install")
+        self.do_run_in_chroot(["grub-install", "--force", setup.grub_device, "--recheck"], timeout=GRUB_INSTALL_TIMEOUT, check=True)
+        # os-prober reuses what the partitioning screen found on the partitions which did not change since
+        os_prober = OSProberCache().load()
+        wrapped = os_prober.write_wrapper("/target", self.get_os_prober_devices(setup), self.do_run_in_chroot)
+        try:
+            # update-grub is grub-mkconfig, generate the configuration once and check what it generated
+            problems = self.do_check_grub(our_total, our_current, self.do_configure_grub(our_total, our_current))
             grub_retries = 0
-            while (not self.do_check_grub(our_total, our_current)):
-                self.do_configure_grub(our_total, our_current)
+            while problems and any(problem.retriable for problem in problems) and grub_retries < GRUB_RETRIES:
                 grub_retries = grub_retries + 1
-                if grub_retries >= 5:
-                    self.error_message(message=_("WARNING: The grub bootloader was not configured properly! You need to configure it manually."))
-                    break
+                print(" --> Generating the grub configuration again (%d/%d)" % (grub_retries, GRUB_RETRIES))
+                problems = self.do_check_grub(our_total, our_current, self.do_configure_grub(our_total, our_current))
+        finally:
+            if wrapped:
+                os_prober.remove_wrapper("/target", self.do_run_in_chroot)
+        if problems:
+            for problem in problems:
+                print("WARNING: %s" % problem)
+            self.error_message(message=_("WARNING: The grub bootloader was not configured properly! You need to configure it manually."))
+            # not checkpointed, a resumed installation configures grub again
+            return False
 
+    def get_os_prober_devices(self, setup):
+        ''' The (path, UUID) of the partitions os-prober would look at: not ours, with a filesystem '''
+        ours = set(partition.path for partition in setup.partitions if partition.mount_as or partition.format_as)
+        devices = []
+        for device in self.blockdevs.devices():
+            fstype = self.blockdevs.get_type(device)
+            if device in ours or fstype in (None, 'swap', 'squashfs', 'LVM2_member', 'linux_raid_member'):
+                continue
+            # os-prober skips what a dm or md device is built on, and so do we
+            node, disk = self.blockdevs.get_device(device), self.blockdevs.get_disk(device)
+            if node.holders or node.type in ('loop', 'rom') or (disk is not None and disk.path.startswith(('/dev/zram', '/dev/ram'))):
+                continue
+            devices.append((device, self.blockdevs.get_uuid(device)))
+        return devices
+
+    def queue_recovery_packages(self, setup):
         # Recovery Mode : Install packages
         for partition in setup.partitions:
             if(partition.mount_as == "/recovery"):
                 print(" --> Configuring Recovery Mode")
-                os.system("mkdir -p /target/debs")
 
                 # UEFI boot
                 if(partition.mount_as == "/boot/efi"):
                     # install recovery pkgs
-                    os.system("cp /run/live/medium/pool/main/f/fsarchiver/*.deb /target/debs/")
-                    os.system("cp /run/live/medium/pool/main/g/gooroom-recovery-utils/*.deb /target/debs/")
-
-                    # remove grub pkgs
-                    self.do_run_in_chroot("apt remove --purge --yes grub-common grub-efi-amd64 grub-efi-amd64-bin grub2-common")
+                    self.packages.install("*", source="fsarchiver")
+                    self.packages.install("*", source="gooroom-recovery-utils")
 
                 # Legacy boot
                 else:
                     # install recovery pkgs
-                    os.system("cp /run/live/medium/pool/main/f/fsarchiver/*.deb /target/debs/")
-                    os.system("cp /run/live/medium/pool/main/g/gooroom-recovery-utils/*.deb /target/debs/")
-                    os.system("cp /run/live/medium/pool/main/e/efibootmgr/efibootmgr* /target/debs/")
-                    os.system("cp /run/live/medium/pool/main/e/efivar/* /target/debs/")
+                    self.packages.install("*", source="fsarchiver")
+                    self.packages.install("*", source="gooroom-recovery-utils")
+                    self.packages.install("efibootmgr*", source="efibootmgr")
+                    self.packages.install("*", source="efivar")
 
-                    # remove grub pkgs
-                    self.do_run_in_chroot("DEBIAN_FRONTEND=noninteractive apt -o \"Dpkg::Option::=--force-confold\" purge -y grub-common grub-efi-amd64 grub-efi-amd64-bin grub2-common")
+                # remove grub pkgs
+                self.packages.purge("grub-common", "grub-efi-amd64", "grub-efi-amd64-bin", "grub2-common")
 
                 # install gooroom-grub pkgs
-                os.system("cp /run/live/medium/pool/main/g/gooroom-grub/*.deb /target/debs/")
-
-                # install pkgs
-                self.do_run_in_chroot("dpkg -i /debs/*.deb")
-                os.system("rm -rf /target/debs")
-
-        # IMA Mode
-        if os.path.exists("/run/live/medium/pool/main/g/gooroom-exe-protector"):
-            print(" --> IMA : installing gooroom-exe-protector")
-            os.system("mkdir -p /target/debs")
-            os.system("cp /run/live/medium/pool/main/g/gooroom-exe-protector/*.deb /target/debs/")
-            self.do_run_in_chroot("dpkg -i /debs/*.deb")
-            os.system("rm -rf /target/debs")
-
-            print(" --> Writing file signatures")
-            our_current += 1
-            self.update_progress(our_total, our_current, False, False, _("Writing file signatures"))
-            os.system("chroot /target/ /bin/bash -c \"/ima/setsigs.sh /ima\"")
-            os.system("rm -rf /target/ima")
-        else:
-            # Recreate initramfs (needed in case of skip_mount also, to include things like mdadm/dm-crypt/etc in case its needed to boot a custom install)
-            print(" --> Configuring Initramfs")
-            our_current += 1
-            self.do_run_in_chroot("/usr/sbin/update-initramfs -t -u -k all")
-            kernelversion= subprocess.check_output("uname -r", shell=True, universal_newlines=True)
-            self.do_run_in_chroot("/usr/bin/sha1sum /boot/initrd.img-%s > /var/lib/initramfs-tools/%s" % (kernelversion,kernelversion))
+                self.packages.install("*", source="gooroom-grub")
 
+    def step_install_exe_protector(self, setup):
+        our_total = 12
+        our_current = 10
+        # IMA Mode, gooroom-exe-protector was installed with the other packages
+        print(" --> Writing file signatures")
+        self.update_progress(our_total, our_current, False, False, _("Writing file signatures"))
+        if self.do_run_in_chroot(["/bin/bash", "/ima/setsigs.sh", "/ima"]) != 0:
+            # keep /ima, a resumed installation signs the files again
+            return False
+        self.run_command(["rm", "-rf", "/target/ima"])
+
+    def step_update_initramfs(self, setup):
+        # Recreate initramfs (needed in case of skip_mount also, to include things like mdadm/dm-crypt/etc in case its needed to boot a custom install)
+        print(" --> Configuring Initramfs")
+        kernelversion = self.kernel_version
+        if self.initramfs_compress:
+            initramfs.write_compress_conf("/target", self.initramfs_compress)
+        # the live initrd is never kept: it has live-boot, which the target purged, and it
+        # knows nothing of the target's fstab, crypttab and resume device.
+        # Only the kernel copied by init_install, the live medium has no other
+        if self.do_run_in_chroot(["/usr/sbin/update-initramfs", "-t", "-u", "-k", kernelversion]) != 0:
+            # not checkpointed, a resumed installation generates the image again
+            return False
+        if os.path.exists("/target/boot/initrd.img-%s" % kernelversion):
+            initramfs.write_checksum("/target", kernelversion)
+
+    def step_copy_recovery_boot(self, setup):
         # Recovery Mode : Copy vmlinuz and initrd.img to recovery directory
         for partition in setup.partitions:
             if(partition.mount_as == "/recovery"):
-                os.system("mkdir -p /target/recovery/boot")
-                os.system("cp -f /target/boot/vmlinuz-* /target/recovery/boot")
-                os.system("cp -f /target/boot/initrd.img-* /target/recovery/boot")
+                os.makedirs("/target/recovery/boot", exist_ok=True)
+                result = self.run_command(["cp", "-f"] + sorted(glob.glob("/target/boot/vmlinuz-*") + glob.glob("/target/boot/initrd.img-*")) +
+                                          ["/target/recovery/boot"])
+                return result.returncode == 0
 
+    def step_clean_apt(self, setup):
+        our_total = 12
+        our_current = 11
         # Clean APT
         print(" --> Cleaning APT")
-        our_current += 1
         self.update_progress(our_current, our_total, True, False, _("Cleaning APT"))
-        os.system("chroot /target/ /bin/sh -c \"dpkg --configure -a\"")
-        self.do_run_in_chroot("sed -i 's/^deb cdrom/#deb cdrom/' /etc/apt/sources.list")
-        self.do_run_in_chroot("apt --yes autoremove")
+        self.do_run_in_chroot(["dpkg", "--configure", "-a"])
+        self.do_run_in_chroot(["sed", "-i", "s/^deb cdrom/#deb cdrom/", "/etc/apt/sources.list"])
+        self.do_run_in_chroot(["apt", "--yes", "autoremove"])
 
+    def step_unmount_partitions(self, setup):
         # now unmount it
         print(" --> Unmounting partitions")
+        # the worker keeps /target busy
+        self.chroot.stop()
 
+        mountpoints = []
         if os.path.exists("/target/sys/firmware/efi/efivars"):
-            os.system("umount --force /target/sys/firmware/efi/efivars")
-
-        os.system("umount --force /target/dev/shm")
-        os.system("umount --force /target/dev/pts")
+            mountpoints.append("/target/sys/firmware/efi/efivars")
+        mountpoints += ["/target/dev/shm", "/target/dev/pts"]
         if setup.gptonefi:
-            os.system("umount --force /target/boot/efi")
-            os.system("umount --force /target/media/cdrom")
-        os.system("umount --force /target/dev/")
-        os.system("umount --force /target/sys/fs/fuse/connections")
-        os.system("umount --force /target/sys/")
-        os.system("umount --force /target/proc/")
-        os.system("umount --force /target/run/")
-        os.system("rm -f /target/etc/resolv.conf")
-        os.system("mv /target/etc/resolv.conf.bk /target/etc/resolv.conf")
+            mountpoints += ["/target/boot/efi", "/target/media/cdrom"]
+        mountpoints += ["/target/dev/", "/target/sys/fs/fuse/connections", "/target/sys/", "/target/proc/", "/target/run/"]
+        for mountpoint in mountpoints:
+            self.run_command(["umount", "--force", mountpoint], timeout=MOUNT_TIMEOUT)
+        self.run_command(["rm", "-f", "/target/etc/resolv.conf"])
+        self.run_command(["mv", "/target/etc/resolv.conf.bk", "/target/etc/resolv.conf"])
         if(not setup.skip_mount):
             for partition in setup.partitions:
                 if(partition.mount_as is not None and partition.mount_as != "" and partition.mount_as != "/" and partition.mount_as != "swap"):
@@ -592,92 +996,118 @@ class InstallerEngine:
 
             # btrfs subvolumes are mounts, but will block unmounting /target. This will
             # unmount the submounts also.
-            cmd = "umount -AR /target"
-            print("Unmounting the target root: '%s'" % cmd)
-            self.exec_cmd(cmd)
+            print("Unmounting the target root")
+            self.run_command(["umount", "-AR", "/target"], timeout=MOUNT_TIMEOUT)
         self.do_unmount("/source")
 
-        ## Recovery Mode
-        self.do_archive_partition(our_total, our_current, setup)
-
-        self.update_progress(0, 0, False, True, _("Installation finished"))
-        print(" --> All done")
-
     def do_run_firmware_atheros(self, device):
-        try :
-            subprocess.check_output('dmidecode | grep -q %s' %device, shell=True, universal_newlines=True)
-        except subprocess.CalledProcessError as e:
-            if e.returncode == 1:
-                print("Found %s" %device)
-                os.system("mkdir -p /target/debs")
-                os.system("cp /lib/live/mount/medium/pool/main/f/firmware-nonfree/firmware-atheros*.deb /target/debs/")
-                self.do_run_in_chroot("dpkg -i /debs/*")
-            else:
-                print("Not found %s" %device)
+        result = self.run_command(["dmidecode"], capture=True, log=None)
+        if any(device in line for line in result.output):
+            print("Found %s" %device)
+            self.packages.install("firmware-atheros*", source="firmware-nonfree")
+        else:
+            print("Not found %s" %device)
 
-    def do_run_in_chroot(self, command):
-        command = command.replace('"', "'").strip()
-        print("chroot /target/ /bin/sh -c \"%s\"" % command)
-        os.system("chroot /target/ /bin/sh -c \"%s\"" % command)
+    def do_run_in_chroot(self, command, env=None, timeout=None, check=False):
+        ''' Runs command (an argv list, or a shell command line) in /target, returns its exit status.
+        With check, anything but a zero exit status raises. '''
+        if isinstance(command, str):
+            argv = ["/bin/sh", "-c", command.strip()]
+        else:
+            argv = list(command)
+        self.cancellation.check()
+        if not self.chroot.is_running():
+            self.chroot.start()
+        cmdline = " ".join(argv)
+        print("chroot /target/ %s" % cmdline)
+        with self.timeline.step("chroot: %s" % cmdline, "chroot") as step:
+            result = self.chroot.run(argv, env, timeout=timeout, cancel=self.cancellation, log=self._log_chroot_line)
+            step.status = result.returncode
+            self.timeline.add_rusage(result.rusage)
+        # stopped by cancel(), raises CommandCancelled
+        self.cancellation.check()
+        if result.timed_out:
+            raise Exception("'%s' timed out after %ds in /target" % (cmdline, timeout))
+        if result.returncode != 0:
+            if check:
+                raise Exception("'%s' exited with %d in /target" % (cmdline, result.returncode))
+            print("WARNING: '%s' exited with %d after %.1fs" % (cmdline, result.returncode, result.wall))
+        return result.returncode
+
+    def _log_chroot_line(self, line):
+        if line.strip():
+            print("    " + line)
 
     def do_configure_grub(self, our_total, our_current):
+        ''' Runs grub-mkconfig once, keeping its output in the log, and returns its exit status '''
         self.update_progress(our_current, our_total, True, False, _("Configuring bootloader"))
         #if not setup.gptonefi:
         print(" --> Running grub-mkconfig")
-        self.do_run_in_chroot("grub-mkconfig -o /boot/grub/grub.cfg")
-        grub_output = subprocess.check_output("chroot /target/ /bin/sh -c \"grub-mkconfig -o /boot/grub/grub.cfg\"", shell=True, universal_newlines=True)
+        self.cancellation.check()
+        with self.timeline.step("grub-mkconfig", "grub") as step:
+            # grub-mkconfig reports what it found (kernels, other OSes) on stderr
+            result = self.chroot.run(["grub-mkconfig", "-o", "/boot/grub/grub.cfg"], timeout=GRUB_MKCONFIG_TIMEOUT,
+                                     cancel=self.cancellation, log=self._log_chroot_line)
+            step.status = result.returncode
+            self.timeline.add_rusage(result.rusage)
+        self.cancellation.check()
         grubfh = open("/var/log/live-installer-grub-output.log", "w")
-        grubfh.writelines(grub_output)
+        grubfh.write(result.stdout)
+        grubfh.write(result.stderr)
         grubfh.close()
+        if result.timed_out:
+            # running it again would only hang again
+            raise Exception("'grub-mkconfig' timed out after %ds in /target" % GRUB_MKCONFIG_TIMEOUT)
+        return result.returncode
 
-
-    def do_check_grub(self, our_total, our_current):
+    def do_check_grub(self, our_total, our_current, returncode=0):
+        ''' Returns the problems (bootloader.GrubProblem) of the generated grub.cfg '''
         self.update_progress(our_current, our_total, True, False, _("Checking bootloader"))
         print(" --> Checking Grub configuration")
-        time.sleep(5)
-        found_entry = False
-        if os.path.exists("/target/boot/grub/grub.cfg"):
-            grubfh = open("/target/boot/grub/grub.cfg", "r")
-            for line in grubfh:
-                line = line.rstrip("\r\n")
-                #if("06_gooroom_theme" in line):
-                #    found_theme = True
-                #    print " --> Found Grub theme: %s " % line
-                if ("menuentry" in line and ("class gooroom" in line or "Gooroom" in line or "Debian" in line)):
-                    found_entry = True
-                    print(" --> Found Grub entry: %s " % line)
-            grubfh.close()
-            return (found_entry)
-        else:
-            print("!No /target/boot/grub/grub.cfg file found!")
-            return False
+        problems = []
+        if returncode != 0:
+            problems.append(GrubProblem('failed', "grub-mkconfig exited with %d" % returncode))
+        problems += check_grub_config("/target/boot/grub/grub.cfg")
+        if not problems:
+            result = self.chroot.run(["grub-script-check", "/boot/grub/grub.cfg"])
+            # 127: no grub-script-check in this grub
+            if result.returncode not in (0, 127):
+                problems.append(GrubProblem('syntax', "grub-script-check: %s" % (result.stderr or result.stdout).strip()))
+        if not problems:
+            print(" --> The grub configuration is fine")
+        return problems
 
     def do_mount(self, device, dest, type, options=None):
         ''' Mount a filesystem '''
-        p = None
         if(options is not None):
-            cmd = "mount -o %s -t %s %s %s" % (options, type, device, dest)
+            cmd = ["mount", "-o", options, "-t", type, device, dest]
         else:
-            cmd = "mount -t %s %s %s" % (type, device, dest)
-        print("EXECUTING: '%s'" % cmd)
-        self.exec_cmd(cmd)
+            cmd = ["mount", "-t", type, device, dest]
+        with self.timeline.step("mount %s" % device, "mount", mountpoint=dest) as step:
+            step.status = self.run_command(cmd, timeout=MOUNT_TIMEOUT).returncode
 
     def do_unmount(self, mountpoint):
         ''' Unmount a filesystem '''
-        cmd = "umount %s" % mountpoint
-        print("EXECUTING: '%s'" % cmd)
-        self.exec_cmd(cmd)
-
-    # Execute schell command and return output in a list
-    def exec_cmd(self, cmd):
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-        lstOut = []
-        for line in p.stdout.readlines():
-            # Strip the line, also from null spaces (strip() only strips white spaces)
-            line = line.strip().strip("\0")
-            if line != '':
-                lstOut.append(line)
-        return lstOut
+        self.run_command(["umount", mountpoint], timeout=MOUNT_TIMEOUT)
+
+    def run_command(self, argv, timeout=None, check=False, capture=False, log=print):
+        ''' Runs argv on the host, streaming its output (to log), and returns a commands.CommandResult.
+        A timeout or a failure (with check) raises a CommandError telling which command it was. '''
+        print("EXECUTING: '%s'" % " ".join(argv))
+        try:
+            result = commands.run(argv, timeout=timeout, cancel=self.cancellation, capture=capture, log=log)
+        except CommandCancelled as detail:
+            if detail.result.argv:
+                self.timeline.add_command(detail.result.argv, detail.result.duration, detail.result.rusage, detail.result.returncode)
+            raise
+        self.timeline.add_command(result.argv, result.duration, result.rusage, result.returncode)
+        if result.timed_out:
+            raise CommandError(result)
+        if result.returncode != 0:
+            if check:
+                raise CommandError(result)
+            print("WARNING: %s" % result.describe())
+        return result
 
 # Represents the choices made by the user
 class Setup(object):
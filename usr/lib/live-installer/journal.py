@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+JOURNAL_FILE = '/tmp/live-installer/journal.json'
+# where the journal is mirrored on the target, relative to its root
+TARGET_JOURNAL_FILE = 'var/lib/live-installer/journal.json'
+
+
+def get_fingerprint(engine, setup):
+    ''' Identifies an installation: a journal is only resumed by an installation
+    with the same medium, partitioning and choices '''
+    try:
+        st = os.stat(engine.media)
+        media = (engine.media, st.st_size, int(st.st_mtime))
+    except OSError:
+        media = (engine.media,)
+    partitions = sorted((p.path, p.mount_as or '', p.format_as or '') for p in setup.partitions)
+    choices = (setup.language, setup.timezone, setup.keyboard_model, setup.keyboard_layout,
+               setup.keyboard_variant, setup.hostname, setup.grub_device, setup.skip_mount,
+               engine.media_type, engine.deploy_mode)
+    return hashlib.sha1(repr((media, partitions, choices)).encode('utf-8')).hexdigest()
+
+
+class InstallJournal(object):
+    ''' Records the completed installation steps so that an interrupted installation
+    can resume from the last good checkpoint instead of starting over.
+
+    The journal lives in /tmp/live-installer and, once /target is mounted, is
+    mirrored on the target itself so that it also survives a reboot. '''
+
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self.target = None
+        self.fingerprint = None
+        self.steps = {}
+        self.resumed = False
+        # steps are marked done from the scheduler's threads
+        self._lock = threading.Lock()
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            return data['fingerprint'], dict(data['steps'])
+        except (IOError, ValueError, KeyError, TypeError):
+            return None, {}
+
+    def open(self, fingerprint, candidates=()):
+        ''' Resume the first journal (this one, then candidates) matching fingerprint, or start afresh '''
+        self.fingerprint = fingerprint
+        self.steps = {}
+        self.resumed = False
+        for path in (self.path,) + tuple(candidates):
+            found, steps = self._read(path)
+            if found == fingerprint and steps:
+                print(" --> Resuming the installation journal %s (%d steps done)" % (path, len(steps)))
+                self.steps = steps
+                self.resumed = True
+                break
+        self._write(self.path)
+
+    def set_target(self, root):
+        ''' Mirror the journal on the target mounted at root '''
+        self.target = os.path.join(root, TARGET_JOURNAL_FILE)
+        self._write(self.target)
+
+    def is_done(self, step):
+        return step in self.steps
+
+    def mark_done(self, step):
+        with self._lock:
+            self.steps[step] = time.time()
+            self._write(self.path)
+            if self.target is not None:
+                self._write(self.target)
+
+    def detach_target(self):
+        ''' Stop mirroring on the target and remove the copy there, before it is unmounted for good '''
+        if self.target is not None and os.path.exists(self.target):
+            os.remove(self.target)
+            try:
+                os.rmdir(os.path.dirname(self.target))
+            except OSError:
+                pass
+        self.target = None
+
+    def discard(self):
+        ''' The installation is complete, forget it '''
+        self.detach_target()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.steps = {}
+
+    def _write(self, path):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + '.new'
+            with open(tmp, 'w') as f:
+                json.dump({'fingerprint': self.fingerprint, 'steps': dict(self.steps)}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, path)
+        except (IOError, OSError) as detail:
+            print("WARNING: Could not write the installation journal %s: %s" % (path, detail))
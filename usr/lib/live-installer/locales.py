@@ -0,0 +1,32 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+import re
+
+
+def normalize(name):
+    ''' The name of a locale as localedef --list-archive shows it, i.e. ko_KR.utf8 for ko_KR.UTF-8 '''
+    match = re.match(r'^([^.@]+)(?:\.([^@]+))?(@.+)?$', name)
+    if match is None:
+        return name
+    language, codeset, modifier = match.groups()
+    if codeset:
+        language += '.' + re.sub(r'[^a-z0-9]', '', codeset.lower())
+    return language + (modifier or '')
+
+
+def enable_locale(path, locale, charset):
+    ''' Enables "locale charset" in the locale.gen at path, returns all the enabled locales '''
+    with open(path) as f:
+        lines = f.read().splitlines()
+    entry = "%s %s" % (locale, charset)
+    found = False
+    for i, line in enumerate(lines):
+        if line.lstrip('# \t').split() == entry.split():
+            lines[i] = entry
+            found = True
+    if not found:
+        lines.append(entry)
+    with open(path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    return [line.split()[0] for line in lines if line.strip() and not line.lstrip().startswith('#')]
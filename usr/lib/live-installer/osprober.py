@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+import os
+import json
+import threading
+
+OS_PROBER_CACHE = '/tmp/live-installer/os-prober.json'
+# grub's 30_os-prober runs whichever os-prober is in PATH, the wrapper takes the place
+# of the real one (diverted to REAL_OS_PROBER) for the duration of grub-mkconfig
+WRAPPER = '/usr/bin/os-prober'
+REAL_OS_PROBER = '/usr/bin/os-prober.real'
+# what os-prober's tests look for at the top of a partition (lower case, they ignore it
+# on FAT and NTFS), a partition with none of them holds nothing os-prober would find
+OS_PROBER_MARKERS = set(['efi', 'bootmgr', 'ntldr', 'boot.ini', 'io.sys', 'msdos.sys', 'command.com',
+                         'kernel.sys', 'windows', 'winnt', 'system', 'mach_kernel', 'etc', 'lib', 'lib64',
+                         'usr', 'boot', 'hurd', 'minix', 'platform', '.boot', 'bsd', 'vmlinuz', 'dos'])
+# the EFI directories detect() knows all about
+EFI_KNOWN = set(['boot', 'microsoft', 'debian', 'gooroom'])
+
+
+def detect(path, mount_point, description):
+    ''' The os-prober lines ("device:long name:short name:type") of the partition path mounted
+    at mount_point, from what the partitioning screen found there. None when os-prober
+    could find more than this does, it has to look at the partition itself. '''
+    exists = lambda *names: os.path.exists(os.path.join(mount_point, *names))
+    try:
+        top = set(name.lower() for name in os.listdir(mount_point))
+    except OSError:
+        return None
+    if not top & OS_PROBER_MARKERS:
+        return []
+    lines = []
+    if exists('EFI', 'Microsoft', 'Boot', 'bootmgfw.efi'):
+        lines.append("%s@/EFI/Microsoft/Boot/bootmgfw.efi:Windows Boot Manager:Windows:efi" % path)
+    if exists('bootmgr') or exists('ntldr'):
+        name = description if description.startswith('Windows ') and '/' not in description else 'Windows'
+        lines.append("%s:%s:Windows:chain" % (path, name))
+    elif exists('System', 'Library', 'CoreServices', 'SystemVersion.plist'):
+        lines.append("%s:Mac OS X:MacOSX:macosx" % path)
+    elif exists('etc') and (exists('boot') or exists('vmlinuz')) and description:
+        name = description.replace(':', ' ')
+        lines.append("%s:%s:%s:linux" % (path, name, name.split()[0]))
+    if not lines:
+        return None
+    if 'efi' in top:
+        try:
+            loaders = set(name.lower() for name in os.listdir(os.path.join(mount_point, 'EFI')))
+        except OSError:
+            return None
+        if loaders - EFI_KNOWN:
+            # another system's bootloader
+            return None
+    return lines
+
+
+class OSProberCache(object):
+    ''' The os-prober results of the partitions, as found by the partitioning screen,
+    keyed by filesystem UUID so that a partition changed since then is probed again '''
+
+    def __init__(self, path=OS_PROBER_CACHE):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def record(self, device, uuid, lines):
+        if uuid is None or lines is None:
+            return
+        with self._lock:
+            self.entries[uuid] = {'device': device, 'lines': list(lines)}
+
+    def lookup(self, device, uuid):
+        ''' The cached lines of device, or None if it was not probed or changed since '''
+        entry = self.entries.get(uuid)
+        if entry is None or entry['device'] != device:
+            return None
+        return entry['lines']
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.entries = dict(json.load(f))
+        except (IOError, ValueError, TypeError):
+            self.entries = {}
+        return self
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with self._lock:
+                with open(self.path, 'w') as f:
+                    json.dump(self.entries, f, indent=1)
+        except (IOError, OSError) as detail:
+            print("WARNING: Could not write the os-prober cache %s: %s" % (self.path, detail))
+
+    def write_wrapper(self, root, devices, run_in_chroot):
+        ''' Installs an os-prober in root printing the cached results of devices [(path, uuid)],
+        or running the real one if any of them is not cached. The real os-prober is diverted
+        with run_in_chroot(argv) -> exit status. Returns False if os-prober is not installed
+        or could not be diverted. '''
+        wrapper = os.path.join(root, WRAPPER.lstrip('/'))
+        # an interrupted installation may have left the diversion, the wrapper is written again
+        if not os.path.exists(os.path.join(root, REAL_OS_PROBER.lstrip('/'))):
+            if not os.path.exists(wrapper):
+                return False
+            if run_in_chroot(["dpkg-divert", "--local", "--rename", "--divert", REAL_OS_PROBER, "--add", WRAPPER]) != 0:
+                return False
+        cached, probe = [], []
+        for device, uuid in devices:
+            lines = self.lookup(device, uuid)
+            if lines is None:
+                probe.append(device)
+            else:
+                cached.extend(lines)
+        print(" --> os-prober: %d partitions known, %d to probe" % (len(devices) - len(probe), len(probe)))
+        script = ["#!/bin/sh",
+                  "# Written by live-installer for the duration of grub-mkconfig"]
+        if probe:
+            # os-prober cannot be told which partitions to look at, it scans them all as usual
+            script.append('exec %s "$@"' % REAL_OS_PROBER)
+        else:
+            script += ["/bin/cat <<'EOF'"] + cached + ["EOF"]
+        with open(wrapper, 'w') as f:
+            f.write("\n".join(script) + "\n")
+        os.chmod(wrapper, 0o755)
+        return True
+
+    def remove_wrapper(self, root, run_in_chroot):
+        ''' Puts the real os-prober back '''
+        wrapper = os.path.join(root, WRAPPER.lstrip('/'))
+        if os.path.exists(wrapper):
+            os.remove(wrapper)
+        run_in_chroot(["dpkg-divert", "--local", "--rename", "--remove", WRAPPER])
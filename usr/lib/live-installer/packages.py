@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+import os
+import re
+import glob
+import gzip
+import fnmatch
+import shutil
+import subprocess
+import threading
+from urllib.parse import unquote
+
+import commands
+
+MEDIUM_DIR = '/run/live/medium'
+# where the pool is mounted (or the queued packages copied), relative to the target root
+DEBS_DIR = 'debs'
+MOUNT_TIMEOUT = 120
+
+
+class PackageNotFound(Exception):
+    pass
+
+
+class PoolPackage(object):
+
+    def __init__(self, name, version, architecture, path, source):
+        self.name = name
+        self.version = version
+        self.architecture = architecture
+        self.path = path        # relative to the medium, i.e. pool/main/g/grub2/grub-efi-amd64_2.02_amd64.deb
+        self.source = source    # the pool directory, i.e. grub2
+
+    def __repr__(self):
+        return "%s_%s_%s" % (self.name, self.version, self.architecture)
+
+
+def compare_versions(a, b):
+    ''' dpkg's version comparison, returns <0, 0 or >0 '''
+    if a == b:
+        return 0
+    return -1 if commands.run(['dpkg', '--compare-versions', a, 'lt', b], log=None).returncode == 0 else 1
+
+
+class PackagePool(object):
+    ''' Index of the package pool of the live medium.
+
+    The Packages indexes of the medium (dists/*/*/binary-*/Packages[.gz]) are
+    read when there are any, otherwise the pool is scanned once and the name,
+    version and architecture are taken from the file names. '''
+
+    def __init__(self, medium=MEDIUM_DIR):
+        self.medium = medium
+        self.root = os.path.join(medium, 'pool')
+        self._packages = None
+        self._lock = threading.Lock()
+
+    def get_architectures(self):
+        result = commands.run(['dpkg', '--print-architecture'], capture=True, log=None, stderr=subprocess.DEVNULL)
+        if result.returncode != 0 or not result.output:
+            return None
+        return (result.output[0].strip(), 'all')
+
+    def _read_indexes(self):
+        packages = []
+        for index in sorted(glob.glob(os.path.join(self.medium, 'dists', '*', '*', 'binary-*', 'Packages*'))):
+            if index.endswith('.gz'):
+                if os.path.exists(index[:-3]):
+                    continue
+                f = gzip.open(index, 'rt')
+            elif index.endswith('/Packages'):
+                f = open(index)
+            else:
+                continue
+            with f:
+                for stanza in re.split(r'\n\s*\n', f.read()):
+                    fields = {}
+                    for line in stanza.splitlines():
+                        key, sep, value = line.partition(':')
+                        if sep and not line[0].isspace():
+                            fields[key] = value.strip()
+                    if 'Package' in fields and 'Filename' in fields:
+                        path = fields['Filename']
+                        packages.append(PoolPackage(fields['Package'], fields.get('Version', ''), fields.get('Architecture', ''),
+                                                    path, os.path.basename(os.path.dirname(path))))
+        return packages
+
+    def _scan(self):
+        packages = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if not filename.endswith('.deb'):
+                    continue
+                fields = filename[:-4].split('_')
+                if len(fields) != 3:
+                    continue
+                path = os.path.relpath(os.path.join(dirpath, filename), self.medium)
+                packages.append(PoolPackage(fields[0], unquote(fields[1]), fields[2], path, os.path.basename(dirpath)))
+        return packages
+
+    def get_packages(self):
+        with self._lock:
+            if self._packages is None:
+                self._packages = self._read_indexes()
+                if self._packages:
+                    print(" --> Read %d packages from the Packages indexes of %s" % (len(self._packages), self.medium))
+                else:
+                    self._packages = self._scan()
+                    print(" --> Found %d packages in %s" % (len(self._packages), self.root))
+            return self._packages
+
+    def has_source(self, source):
+        return any(package.source == source for package in self.get_packages())
+
+    def find(self, pattern, source=None):
+        ''' The newest package of each name matching the glob pattern (in the source directory), for this architecture.
+        Raises PackageNotFound if there is none. '''
+        architectures = self.get_architectures()
+        found = {}
+        for package in self.get_packages():
+            if not fnmatch.fnmatchcase(package.name, pattern):
+                continue
+            if source is not None and package.source != source:
+                continue
+            if architectures is not None and package.architecture not in architectures:
+                continue
+            other = found.get(package.name)
+            if other is None or compare_versions(package.version, other.version) > 0:
+                found[package.name] = package
+        if not found:
+            raise PackageNotFound("No package matching %s in %s" % (pattern, source or self.root))
+        return [found[name] for name in sorted(found)]
+
+
+class PackageTransaction(object):
+    ''' Queue of the packages to install in, or purge from, the target.
+
+    The installation steps only queue their intents; commit() runs a single
+    apt-get transaction, so dpkg reads its database and runs its triggers
+    (man-db, initramfs-tools, ldconfig) once instead of once per step. If
+    apt-get cannot resolve the transaction offline, the purges and installs
+    are done with dpkg as before. The packages are taken from the pool of the
+    live medium, which is bind mounted read-only in the target instead of
+    copying them. '''
+
+    def __init__(self, pool=None):
+        self.pool = pool if pool is not None else PackagePool()
+        self.debs = []
+        self.purges = []
+        self._lock = threading.Lock()
+
+    def install(self, *patterns, source=None):
+        ''' Queue the pool packages matching the name patterns (in the source directory), returns them.
+        Raises PackageNotFound for a pattern matching nothing. '''
+        found = []
+        for pattern in patterns:
+            found.extend(self.pool.find(pattern, source))
+        with self._lock:
+            for package in found:
+                if package.path not in [deb.path for deb in self.debs]:
+                    self.debs.append(package)
+        return found
+
+    def purge(self, *packages):
+        ''' Queue the packages to purge, those which are not installed are ignored '''
+        with self._lock:
+            for package in packages:
+                if package and package not in self.purges:
+                    self.purges.append(package)
+
+    def is_empty(self):
+        return not self.debs and not self.purges
+
+    def get_installed(self, root):
+        ''' The packages (installed or with config files left) in the target '''
+        result = commands.run(['chroot', root, 'dpkg-query', '-W', '-f=${Package}\t${db:Status-Status}\n'],
+                              capture=True, log=None, stderr=subprocess.DEVNULL)
+        if result.returncode != 0:
+            return None
+        installed = set()
+        for line in result.output:
+            package, sep, status = line.partition('\t')
+            if sep and status != 'not-installed':
+                installed.add(package)
+        return installed
+
+    def commit(self, root, run_in_chroot):
+        ''' Run the queued transaction in root with run_in_chroot(argv, env) -> exit status, then empty the queue.
+        Returns the exit status of the transaction. '''
+        with self._lock:
+            debs, purges = list(self.debs), list(self.purges)
+            self.debs, self.purges = [], []
+        if not debs and not purges:
+            return 0
+
+        # a queued package replaces its installed version, it is not purged first
+        names = set(deb.name for deb in debs)
+        installed = self.get_installed(root)
+        purges = [package for package in purges if package not in names and
+                  (installed is None or package in installed)]
+
+        print(" --> Installing %d packages and purging %d packages" % (len(debs), len(purges)))
+        debdir = os.path.join(root, DEBS_DIR)
+        os.makedirs(debdir, exist_ok=True)
+        mounted = commands.run(['mount', '--bind', '-o', 'ro', self.pool.medium, debdir], timeout=MOUNT_TIMEOUT).returncode == 0
+        if mounted:
+            # older mount(8) ignore ro on the initial bind
+            commands.run(['mount', '-o', 'remount,bind,ro', debdir], timeout=MOUNT_TIMEOUT)
+            targets = ["/%s/%s" % (DEBS_DIR, deb.path) for deb in debs]
+        else:
+            print("WARNING: Could not bind mount %s in the target, copying the packages" % self.pool.medium)
+            targets = []
+            for deb in debs:
+                shutil.copy(os.path.join(self.pool.medium, deb.path), debdir)
+                targets.append("/%s/%s" % (DEBS_DIR, os.path.basename(deb.path)))
+
+        try:
+            env = {'DEBIAN_FRONTEND': 'noninteractive'}
+            cmd = ['apt-get', '--yes', '--purge', '--no-download', '--allow-downgrades',
+                   '-o', 'Dpkg::Options::=--force-confold', 'install'] + targets + [package + '-' for package in purges]
+            status = run_in_chroot(cmd, env)
+            if status != 0:
+                print("WARNING: apt-get could not install the packages (%s), falling back to dpkg" % status)
+                status = 0
+                if purges:
+                    status = run_in_chroot(['dpkg', '-P'] + purges, env)
+                if targets:
+                    status = run_in_chroot(['dpkg', '-i'] + targets, env) or status
+        finally:
+            if mounted:
+                commands.run(['umount', debdir], timeout=MOUNT_TIMEOUT)
+            if not mounted or not os.listdir(debdir):
+                shutil.rmtree(debdir, ignore_errors=True)
+        return status
@@ -5,12 +5,19 @@ import os
 import re
 import sys
 import subprocess
+import threading
+import itertools
 from collections import defaultdict
 
-from gi.repository import Gtk, Gdk
+from gi.repository import Gtk, Gdk, GObject
 import parted
 import gettext
 
+import commands
+import osprober
+import superblock
+from probecache import ProbeCache
+
 gettext.install("live-installer", "/usr/share/gooroom/locale")
 
 def shell_exec(command):
@@ -34,10 +41,38 @@ def is_efi_supported():
     os.system("modprobe efivars >/dev/null 2>&1")
     return os.path.exists("/proc/efi") or os.path.exists("/sys/firmware/efi")
 
+def get_mem_total():
+    ''' The size of the RAM, in kB '''
+    with open('/proc/meminfo') as meminfo:
+        for line in meminfo:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1])
+    return 0
+
 def path_exists(*args):
     return os.path.exists(os.path.join(*args))
 
+def get_mount_point(device):
+    ''' Where device is mounted already, or None '''
+    with open('/proc/mounts') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 1 and fields[0] == device:
+                return fields[1].replace('\\040', ' ')
+    return None
+
 TMP_MOUNTPOINT = '/tmp/live-installer/tmpmount'
+# a damaged filesystem must not freeze the partitioning screen
+PROBE_MOUNT_TIMEOUT = 30
+# how many partitions are probed at the same time, in all and on each disk
+PROBE_WORKERS = 8
+PROBE_JOBS_PER_DISK = 2
+# no journal replay when probing
+MOUNT_OPTIONS = {'ext3': 'noload', 'ext4': 'noload', 'xfs': 'norecovery'}
+# last mounted there, a filesystem holds data rather than a system
+# where a system mounts its own data filesystems, never a system root. Other systems
+# are mounted anywhere else (/mnt/..., /media/..., os-prober's /var/lib/os-prober/mount)
+DATA_MOUNT_POINTS = ('/home', '/srv', '/var', '/tmp', '/data')
 RESOURCE_DIR = '/usr/share/live-installer/'
 
 EFI_MOUNT_POINT = '/boot/efi'
@@ -54,27 +89,43 @@ with open(RESOURCE_DIR + 'disk-partitions.html') as f:
     DISK_TEMPLATE = re.sub('<style>[\s\S]+?</style>', lambda match: match.group().replace('{', '{{').replace('}', '}}'), DISK_TEMPLATE)
 
 
+# what the probes found, for the next scan ("Refresh")
+probe_cache = ProbeCache()
+
 def build_partitions(_installer):
     global installer
     installer = _installer
+    probe_cache.watch()
+    # a scan still running (i.e. the user went back and forth) is replaced by this one
+    previous = installer.builder.get_object("treeview_disks").get_model()
+    if isinstance(previous, PartitionSetup):
+        previous.cancel()
     installer.window.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))  # "busy" cursor
-    installer.window.set_sensitive(False)
+    for button in ("button_next", "button_refresh", "button_edit"):
+        installer.builder.get_object(button).set_sensitive(False)
     print("Starting PartitionSetup()")
     partition_setup = PartitionSetup()
-    print("Finished PartitionSetup()")
-    if partition_setup.disks:
-        installer._selected_disk = partition_setup.disks[0][0]
-        print("Loading HTML string")
-        #installer.partitions_browser.load_string(partition_setup.get_html(installer._selected_disk), 'text/html', 'UTF-8', 'file:///')
-        installer.partitions_browser.load_html(partition_setup.get_html(installer._selected_disk), 'file:///')
+    installer._selected_disk = partition_setup.disks[0][0] if partition_setup.disks else None
+    installer.partitions_browser.load_html("", 'file:///')
     print("Showing the partition screen")
     installer.builder.get_object("scrolled_partitions").show_all()
     installer.builder.get_object("treeview_disks").set_model(partition_setup)
-    installer.builder.get_object("treeview_disks").expand_all()
+    # the disks and partitions show up as they are found, the screen is usable meanwhile
+    partition_setup.scan(_scan_finished)
+
+def _scan_finished(partition_setup):
+    print("Finished PartitionSetup()")
     installer.window.get_window().set_cursor(None)
-    installer.window.set_sensitive(True)
+    for button in ("button_next", "button_refresh", "button_edit"):
+        installer.builder.get_object(button).set_sensitive(True)
     build_grub_partitions()
 
+def _disk_ready(partition_setup, disk_path):
+    installer.builder.get_object("treeview_disks").expand_all()
+    if disk_path == installer._selected_disk:
+        print("Loading HTML string")
+        installer.partitions_browser.load_html(partition_setup.get_html(disk_path), 'file:///')
+
 def update_html_preview(selection):
     model, row = selection.get_selected()
     try: disk = model[row][IDX_PART_DISK]
@@ -161,7 +212,10 @@ def manually_edit_partitions(widget):
 
 def build_grub_partitions():
     grub_model = Gtk.ListStore(str)
-    try: preferred = [p.partition.disk.device.path for p in installer.setup.partitions if p.mount_as == '/'][0]
+    def _get_disk(partition):
+        disk = installer.setup.partition_setup.blockdevs.get_disk(partition.path)
+        return disk.path if disk is not None else partition.partition.disk.device.path
+    try: preferred = [_get_disk(p) for p in installer.setup.partitions if p.mount_as == '/'][0]
     except IndexError: preferred = ''
     devices = sorted(list(d[0] for d in installer.setup.partition_setup.disks) +
                      list([_f for _f in (p.name for p in installer.setup.partitions) if _f]))
@@ -188,166 +242,212 @@ class PartitionSetup(Gtk.TreeStore):
         installer.setup.partition_setup = self
         self.html_disks, self.html_chunks = {}, defaultdict(list)
 
+        # the device graph, shared with the installation
+        self.blockdevs = installer.installer.blockdevs
+        self.blockdevs.invalidate()
+
         def _get_attached_disks():
             disks = []
             exclude_devices = ['/dev/sr0', '/dev/sr1', '/dev/cdrom', '/dev/dvd', '/dev/fd0']
-            try:
-                live_device = subprocess.check_output("findmnt -n -o source /run/live/medium", shell=True).split('\n')[0]
-                live_device = re.sub('[0-9]+$', '', live_device) # remove partition numbers if any
-            except:
-                 live_device = None
-            if live_device is not None and live_device.startswith('/dev/'):
-                exclude_devices.append(live_device)
-                print("Excluding %s (detected as the live device)" % live_device)
-            lsblk = shell_exec('LC_ALL=en_US.UTF-8 lsblk -rindo TYPE,NAME,RM,SIZE,MODEL | sort -k3,2')
-            for line in lsblk.stdout:
-                try:
-                    elements = line.strip().split(" ", 4)
-                    if len(elements) < 4:
-                        print("Can't parse blkid output: %s" % elements)
-                        continue
-                    elif len(elements) < 5:
-                        print("Can't find model in blkid output: %s" % elements)
-                        type, device, removable, size, model = elements[0], elements[1], elements[2], elements[3], elements[1]
-                    else:
-                        type, device, removable, size, model = elements
-                    device = "/dev/" + device
-                    if type == "disk" and device not in exclude_devices:
-                        # convert size to manufacturer's size for show, e.g. in GB, not GiB!
-                        unit_index = 'BKMGTPEZY'.index(size.upper()[-1])
-                        l10n_unit = [_('B'), _('kB'), _('MB'), _('GB'), _('TB'), 'PB', 'EB', 'ZB', 'YB'][unit_index]
-
-                        if (int(float(size[:-1]) * (1024/1000)**unit_index) == 0):
-                            continue;
-
-                        size = "%s %s" % (str(int(float(size[:-1]) * (1024/1000)**unit_index)), l10n_unit)
-
-                        model = model.replace("\\x20", " ")
-                        description = '{} ({})'.format(model.strip(), size)
-                        if int(removable):
-                            description = _('Removable:') + ' ' + description
-                        disks.append((device, description))
-                except Exception as detail:
-                    print("Could not parse blkid output: %s (%s)" % (line, detail))
+            for device in self.blockdevs.devices():
+                if self.blockdevs.get_device(device).mountpoint == '/run/live/medium':
+                    live_device = self.blockdevs.get_disk(device)
+                    if live_device is not None:
+                        exclude_devices.append(live_device.path)
+                        print("Excluding %s (detected as the live device)" % live_device.path)
+            for disk in self.blockdevs.disks():
+                if disk.path in exclude_devices:
+                    continue
+                # convert size to manufacturer's size for show, e.g. in GB, not GiB!
+                unit_index = 0
+                while unit_index < 8 and disk.size >= 1024 ** (unit_index + 1):
+                    unit_index += 1
+                if int(disk.size / 1000 ** unit_index) == 0:
+                    continue
+                l10n_unit = [_('B'), _('kB'), _('MB'), _('GB'), _('TB'), 'PB', 'EB', 'ZB', 'YB'][unit_index]
+                size = "%s %s" % (int(disk.size / 1000 ** unit_index), l10n_unit)
+                description = '{} ({})'.format(disk.model or os.path.basename(disk.path), size)
+                if disk.removable:
+                    description = _('Removable:') + ' ' + description
+                disks.append((disk.path, description))
             return disks
 
-        os.popen('mkdir -p ' + TMP_MOUNTPOINT)
+        os.makedirs(TMP_MOUNTPOINT, exist_ok=True)
         installer.setup.gptonefi = is_efi_supported()
         self.disks = _get_attached_disks()
         print('Disks: ', self.disks)
-        already_done_full_disk_format = False
-        for disk_path, disk_description in self.disks:
-            print("    Analyzing path='%s' description='%s'" % (disk_path, disk_description))
-            disk_device = parted.getDevice(disk_path)
-            print("      - Found the device...")
-            try:
-                disk = parted.Disk(disk_device)
-                print("      - Found the disk...")
-            except Exception as detail:
-                print("      - Found an issue while looking for the disk: %s" % detail)
-                """
-                from frontend.gtk_interface import QuestionDialog
-                dialog = QuestionDialog(_("Installation Tool"),
-                                        _("No partition table was found on the hard drive: %s. Do you want the installer to create a set of partitions for you? Note: This will ERASE ALL DATA present on this disk.") % disk_description,
-                                        None, installer.window)
-                """
-                dialog = QuestionDialogWithCheckbox(_("Installation Tool"),
+        self.already_done_full_disk_format = False
+        self.scanned = []
+        self.cancelled = False
+        self.done = False
+        self.probes = PartitionProbes(probe_cache)
+
+    def scan(self, finished):
+        ''' Reads the disks one by one from the main loop (parted and the dialogs stay in the
+        GTK thread) and probes their partitions in the background. Every partition goes into
+        the model as soon as it is probed, and a disk gets its HTML view once they all are.
+        finished(self) is called at the end. '''
+        self.finished = finished
+        self.pending_disks = list(self.disks)
+        GObject.idle_add(self._read_next_disk)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _read_next_disk(self):
+        if self.cancelled:
+            return False
+        if self.pending_disks:
+            disk_path, disk_description = self.pending_disks.pop(0)
+            self.read_disk(disk_path, disk_description)
+        if self.pending_disks:
+            return True
+        self._check_done()
+        return False
+
+    def read_disk(self, disk_path, disk_description):
+        assign_mount_format = None
+        print("    Analyzing path='%s' description='%s'" % (disk_path, disk_description))
+        disk_device = parted.getDevice(disk_path)
+        print("      - Found the device...")
+        try:
+            disk = parted.Disk(disk_device)
+            print("      - Found the disk...")
+        except Exception as detail:
+            print("      - Found an issue while looking for the disk: %s" % detail)
+            """
+            from frontend.gtk_interface import QuestionDialog
+            dialog = QuestionDialog(_("Installation Tool"),
                                     _("No partition table was found on the hard drive: %s. Do you want the installer to create a set of partitions for you? Note: This will ERASE ALL DATA present on this disk.") % disk_description,
-                                    installer.window)
-
-                response = dialog.run()
-                """
-                if response == Gtk.ResponseType.YES:
-                    if is_backup:
-                        pass
-                    else:
-                        # Format without assigning mount points
-                        pass
-                elif response == Gtk.ResponseType.NO:
-                    # User said No
+                                    None, installer.window)
+            """
+            dialog = QuestionDialogWithCheckbox(_("Installation Tool"),
+                                _("No partition table was found on the hard drive: %s. Do you want the installer to create a set of partitions for you? Note: This will ERASE ALL DATA present on this disk.") % disk_description,
+                                installer.window)
+
+            response = dialog.run()
+            """
+            if response == Gtk.ResponseType.YES:
+                if is_backup:
                     pass
-                """
-                if response == Gtk.ResponseType.NO:
-                    dialog.destroy ()
-                    dialog = None
-
-                if not dialog: continue  # the user said No, skip this disk
-
-                try:
-                    is_backup = dialog.checkbox.get_active()
-                    dialog.destroy ()
-
-                    installer.window.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))
-                    print("Performing a full disk format")
-                    if not already_done_full_disk_format:
-                        assign_mount_format = self.full_disk_format(disk_device ,is_backup)
-                        already_done_full_disk_format = True
-                    else:
-                        self.full_disk_format(disk_device, is_backup) # Format but don't assign mount points
-                    installer.window.get_window().set_cursor(None)
-                    print("Done full disk format")
-                    disk = parted.Disk(disk_device)
-                    print("Got disk!")
-                except Exception as second_exception:
-                    installer.window.get_window().set_cursor(None)
-                    print("      - Found another issue while looking for the disk: %s" % detail)
-                    continue # Something is wrong with this disk, skip it
-
-            disk_iter = self.append(None, (disk_description, '', '', '', '', '', '', None, disk_path))
-            print("      - Looking at partitions...")
-            free_space_partition = disk.getFreeSpacePartitions()
-            print("           -> %d free space partitions" % len(free_space_partition))
-            primary_partitions = disk.getPrimaryPartitions()
-            print("           -> %d primary partitions" % len(primary_partitions))
-            logical_partitions = disk.getLogicalPartitions()
-            print("           -> %d logical partitions" % len(logical_partitions))
-            raid_partitions = disk.getRaidPartitions()
-            print("           -> %d raid partitions" % len(raid_partitions))
-            lvm_partitions = disk.getLVMPartitions()
-            print("           -> %d LVM partitions" % len(lvm_partitions)) 
-            print('free={} pri={} logi={} raid={} lvm={}'.format(free_space_partition, primary_partitions, logical_partitions, raid_partitions, lvm_partitions))
-#partition_set = set(free_space_partition + primary_partitions + logical_partitions + raid_partitions + lvm_partitions)
-            partition_set = free_space_partition + primary_partitions + logical_partitions + raid_partitions + lvm_partitions
+                else:
+                    # Format without assigning mount points
+                    pass
+            elif response == Gtk.ResponseType.NO:
+                # User said No
+                pass
+            """
+            if response == Gtk.ResponseType.NO:
+                dialog.destroy ()
+                dialog = None
 
-            print("           -> set of %d partitions" % len(partition_set))
+            if not dialog: return  # the user said No, skip this disk
 
-            partitions = []
-            for partition in partition_set:
-                part = Partition(partition)
-                print((partition.path, part.size, part.raw_size))
-                # skip ranges <5MB
-                if part.raw_size > 5242880:
-                    partitions.append(part)
+            try:
+                is_backup = dialog.checkbox.get_active()
+                dialog.destroy ()
+
+                installer.window.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))
+                print("Performing a full disk format")
+                if not self.already_done_full_disk_format:
+                    assign_mount_format = self.full_disk_format(disk_device ,is_backup)
+                    self.already_done_full_disk_format = True
                 else:
-                    print(("skipping ", partition.path, part.raw_size))
-            partitions = sorted(partitions, key=lambda part: part.partition.geometry.start)
-
-            print("      - Found partitions...")
-            try: # assign mount_as and format_as if disk was just auto-formatted
-                for partition, (mount_as, format_as) in zip(partitions, assign_mount_format):
-                    partition.mount_as = mount_as
-                    partition.format_as = format_as
-                del assign_mount_format
-            except NameError: pass
-            print("      - Iterating partitions...")
-            # Needed to fix the 1% minimum Partition.size_percent
-            sum_size_percent = sum(p.size_percent for p in partitions) + .5  # .5 for good measure
-            for partition in partitions:
-                print("        . Appending partition %s..." % partition.name)
-                partition.size_percent = round(partition.size_percent / sum_size_percent * 100, 1)
-                installer.setup.partitions.append(partition)
-                self.append(disk_iter, (partition.name,
-                                        '<span foreground="{}">{}</span>'.format(partition.color, partition.type),
-                                        partition.description,
-                                        partition.format_as,
-                                        partition.mount_as,
-                                        partition.size,
-                                        partition.free_space,
-                                        partition,
-                                        disk_path))
-
-            print("      - Loading HTML view...")
-            self.html_disks[disk_path] = DISK_TEMPLATE.format(PARTITIONS_HTML=''.join(PARTITION_TEMPLATE.format(p) for p in partitions))
+                    self.full_disk_format(disk_device, is_backup) # Format but don't assign mount points
+                installer.window.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))
+                print("Done full disk format")
+                self.blockdevs.invalidate()
+                disk = parted.Disk(disk_device)
+                print("Got disk!")
+            except Exception as second_exception:
+                installer.window.get_window().set_cursor(None)
+                print("      - Found another issue while looking for the disk: %s" % detail)
+                return # Something is wrong with this disk, skip it
+
+        disk_iter = self.append(None, (disk_description, '', '', '', '', '', '', None, disk_path))
+        print("      - Looking at partitions...")
+        free_space_partition = disk.getFreeSpacePartitions()
+        print("           -> %d free space partitions" % len(free_space_partition))
+        primary_partitions = disk.getPrimaryPartitions()
+        print("           -> %d primary partitions" % len(primary_partitions))
+        logical_partitions = disk.getLogicalPartitions()
+        print("           -> %d logical partitions" % len(logical_partitions))
+        raid_partitions = disk.getRaidPartitions()
+        print("           -> %d raid partitions" % len(raid_partitions))
+        lvm_partitions = disk.getLVMPartitions()
+        print("           -> %d LVM partitions" % len(lvm_partitions)) 
+        print('free={} pri={} logi={} raid={} lvm={}'.format(free_space_partition, primary_partitions, logical_partitions, raid_partitions, lvm_partitions))
+#partition_set = set(free_space_partition + primary_partitions + logical_partitions + raid_partitions + lvm_partitions)
+        partition_set = free_space_partition + primary_partitions + logical_partitions + raid_partitions + lvm_partitions
+
+        print("           -> set of %d partitions" % len(partition_set))
+
+        scan = DiskScan(disk_path, disk_iter, [Partition(partition) for partition in partition_set], assign_mount_format)
+        self.scanned.append(scan)
+        if not scan.partitions:
+            self._finish_disk(scan)
+        for partition in scan.partitions:
+            self.probes.submit(partition, disk_path, lambda partition, scan=scan: GObject.idle_add(self._add_partition, scan, partition))
+
+    def _add_partition(self, scan, partition):
+        ''' Puts a probed partition of scan in the model, in geometry order '''
+        if self.cancelled:
+            return False
+        scan.pending -= 1
+        print((partition.path, partition.size, partition.raw_size))
+        # skip ranges <5MB
+        if partition.raw_size > 5242880:
+            position = len([part for part in scan.shown if part.start < partition.start])
+            scan.shown.insert(position, partition)
+            print("        . Appending partition %s..." % partition.name)
+            self.insert(scan.iter, position, self.get_row(partition, scan.path))
+            installer.setup.partitions = [part for disk in self.scanned for part in disk.shown]
+        else:
+            print(("skipping ", partition.path, partition.raw_size))
+        if scan.pending == 0:
+            self._finish_disk(scan)
+        self._check_done()
+        return False
+
+    def get_row(self, partition, disk_path):
+        return (partition.name,
+                '<span foreground="{}">{}</span>'.format(partition.color, partition.type),
+                partition.description,
+                partition.format_as,
+                partition.mount_as,
+                partition.size,
+                partition.free_space,
+                partition,
+                disk_path)
+
+    def _finish_disk(self, scan):
+        print("      - Found partitions of %s..." % scan.path)
+        partitions = scan.shown
+        if scan.assign_mount_format is not None:
+            # assign mount_as and format_as if disk was just auto-formatted
+            for partition, (mount_as, format_as) in zip(partitions, scan.assign_mount_format):
+                partition.mount_as = mount_as
+                partition.format_as = format_as
+            for row in self[scan.iter].iterchildren():
+                row[IDX_PART_MOUNT_AS], row[IDX_PART_FORMAT_AS] = row[IDX_PART_OBJECT].mount_as, row[IDX_PART_OBJECT].format_as
+        # Needed to fix the 1% minimum Partition.size_percent
+        sum_size_percent = sum(p.size_percent for p in partitions) + .5  # .5 for good measure
+        for partition in partitions:
+            partition.size_percent = round(partition.size_percent / sum_size_percent * 100, 1)
+        print("      - Loading HTML view...")
+        self.html_disks[scan.path] = DISK_TEMPLATE.format(PARTITIONS_HTML=''.join(PARTITION_TEMPLATE.format(p) for p in partitions))
+        _disk_ready(self, scan.path)
+
+    def _check_done(self):
+        if self.done or self.pending_disks or any(scan.pending for scan in self.scanned):
+            return
+        self.done = True
+        # the bootloader stage reuses what was found here instead of running os-prober again
+        os_prober_cache = osprober.OSProberCache()
+        for partition in installer.setup.partitions:
+            os_prober_cache.record(partition.path, partition.uuid or self.blockdevs.get_uuid(partition.path), partition.os_prober)
+        os_prober_cache.save()
+        self.finished(self)
 
     def get_html(self, disk):
         if disk in self.html_disks:
@@ -366,17 +466,19 @@ class PartitionSetup(Gtk.TreeStore):
         mkpart = (
             # (condition, mount_as, format_as, mkfs command, size_mb)
             # EFI
-            (installer.setup.gptonefi, EFI_MOUNT_POINT, 'vfat', 'mkfs.vfat {} -F 32 ', 300),
+            (installer.setup.gptonefi, EFI_MOUNT_POINT, 'vfat', ['mkfs.vfat', '{}', '-F', '32'], 300),
             # swap - equal to RAM for hibernate to work well (but capped at ~8GB)
-            (True, SWAP_MOUNT_POINT, 'swap', 'mkswap {}', min(8800, int(round(1.1/1024 * int(getoutput("awk '/^MemTotal/{ print $2 }' /proc/meminfo")), -2)))),
+            (True, SWAP_MOUNT_POINT, 'swap', ['mkswap', '{}'], min(8800, int(round(1.1/1024 * get_mem_total(), -2)))),
             # root
-            (True, '/', 'ext4', 'mkfs.ext4 -F {}', 30000 if separate_home_partition else (1 if is_backup else 0)),
+            (True, '/', 'ext4', ['mkfs.ext4', '-F', '{}'], 30000 if separate_home_partition else (1 if is_backup else 0)),
             # home
-            (separate_home_partition, '/home', 'ext4', 'mkfs.ext4 -F {}', 1 if is_backup else 0),
+            (separate_home_partition, '/home', 'ext4', ['mkfs.ext4', '-F', '{}'], 1 if is_backup else 0),
             #BACKUP
-            (is_backup, '', 'ext4', 'mkfs.ext4 -F {}', 0),
+            (is_backup, '', 'ext4', ['mkfs.ext4', '-F', '{}'], 0),
         )
-        run_parted = lambda cmd: os.system('parted --script --align optimal {} {} ; sync'.format(device.path, cmd))
+        def run_parted(cmd):
+            commands.run(['parted', '--script', '--align', 'optimal', device.path] + cmd.split())
+            commands.run(['sync'])
         run_parted('mklabel ' + disk_label)
         start_mb = 2
         partition_number = 0
@@ -392,11 +494,11 @@ class PartitionSetup(Gtk.TreeStore):
                 mkpart_cmd = 'mkpart primary {}MB {}'.format(start_mb, end)
                 print(mkpart_cmd)
                 run_parted(mkpart_cmd)
-                mkfs = mkfs.format("%s%d" % (device.path, partition_number))
-                print(mkfs)
-                os.system(mkfs)
+                mkfs = [arg.format("%s%d" % (device.path, partition_number)) for arg in mkfs]
+                print(" ".join(mkfs))
+                commands.run(mkfs)
                 if is_backup and end == '100%':
-                    os.system ("tune2fs -L GRM_BACKUP %s%d" % (device.path, partition_number))
+                    commands.run(["tune2fs", "-L", "GRM_BACKUP", "%s%d" % (device.path, partition_number)])
                 start_mb += size_mb + 1
                 if end == '78%': start_mb = device.getLength('MB')*0.8
         if installer.setup.gptonefi:
@@ -410,9 +512,54 @@ def to_human_readable(size):
             return "{:.1f} {}".format(size, unit)
         size /= 1000
 
+# numbers the probe mountpoints, the probes of a cancelled scan may still be running
+probe_numbers = itertools.count()
+
+class DiskScan(object):
+    ''' A disk of PartitionSetup while its partitions are probed '''
+
+    def __init__(self, path, iter, partitions, assign_mount_format=None):
+        self.path = path
+        self.iter = iter
+        self.partitions = partitions
+        self.pending = len(partitions)
+        self.shown = []  # the partitions in the model, in geometry order
+        self.assign_mount_format = assign_mount_format
+
+class PartitionProbes(object):
+    ''' Runs Partition.probe in the background, at most PROBE_WORKERS at a time
+    and PROBE_JOBS_PER_DISK at a time on the same disk '''
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.workers = threading.Semaphore(PROBE_WORKERS)
+        self.disks = {}
+
+    def submit(self, partition, disk_path, done=None):
+        ''' Probes partition, then calls done(partition) from the worker thread '''
+        disk = self.disks.setdefault(disk_path, threading.Semaphore(PROBE_JOBS_PER_DISK))
+        # a mountpoint of its own, free space "partitions" may share a path
+        mount_point = os.path.join(TMP_MOUNTPOINT, "%s-%d" % (os.path.basename(partition.path), next(probe_numbers)))
+
+        def _probe():
+            with disk, self.workers:
+                try:
+                    partition.probe(mount_point, self.cache)
+                except Exception as detail:
+                    print("Could not probe %s: %s" % (partition.path, detail))
+            if done is not None:
+                done(partition)
+
+        thread = threading.Thread(target=_probe, name="probe %s" % partition.path)
+        thread.daemon = True
+        thread.start()
+
+
 class Partition(object):
     format_as = ''
     mount_as = ''
+    os_prober = None  # the os-prober lines of the partition, None if unknown
+    uuid = None  # the filesystem UUID, if read from the superblock
 
     def __init__(self, partition):
         assert partition.type not in (parted.PARTITION_METADATA, parted.PARTITION_EXTENDED)
@@ -422,6 +569,7 @@ class Partition(object):
 
         self.partition = partition
         self.length = partition.getLength()
+        self.start = partition.geometry.start
         print("                  . length %d" % self.length)
 
         self.size_percent = max(1, round(80*self.length/partition.disk.device.getLength(), 1))
@@ -464,26 +612,101 @@ class Partition(object):
         if "swap" in self.type:
             self.mount_as = SWAP_MOUNT_POINT
 
-        # identify partition's description and used space
+        self.color = {
+            # colors approximately from gparted (find matching set in usr/share/disk-partitions.html)
+            'btrfs': '#636363',
+            'exfat': '#47872a',
+            'ext2':  '#2582a0',
+            'ext3':  '#2582a0',
+            'ext4':  '#21619e',
+            'fat16': '#47872a',
+            'fat32': '#47872a',
+            'hfs':   '#636363',
+            'jfs':   '#636363',
+            'swap':  '#be3a37',
+            'ntfs':  '#66a6a8',
+            'reiserfs': '#636363',
+            'ufs':   '#636363',
+            'xfs':   '#636363',
+            'zfs':   '#636363',
+            parted.PARTITION_EXTENDED: '#a9a9a9',
+        }.get(self.type, '#a9a9a9')
+
+        # parted is not thread-safe, read what the probe needs now
+        self.parted_type = partition.type
+        try:
+            self.flags = partition.getFlagsAsString().split(", ") if partition.active else []
+        except Exception as detail:
+            # best effort
+            print("Could not read partition flags for %s: %s" % (self.path, detail))
+            self.flags = []
+        self.os_fs_info, self.description, self.free_space, self.used_percent = ': '+self.type, '', '', 0
+        self.set_html()
+
+    def probe(self, mount_point, cache=None):
+        ''' Finds the used space of the partition from its superblock and the description (OS)
+        by mounting it read-only on mount_point, its own, when the files have to be looked at.
+        What an earlier scan found is taken from cache (a ProbeCache) when the partition did not change.
+        Reads nothing from parted, may run in any thread. '''
+        info = None if "swap" in self.type else superblock.read(self.path)
+        if info is not None:
+            print("                  . superblock %s" % info)
+            self.uuid = info.uuid
+        if cache is not None:
+            key = cache.get_key(self)
+            if cache.lookup(self, key):
+                print("                  . unchanged since the last scan")
+                self.set_html()
+                return
+        self.do_probe(mount_point, info)
+        if cache is not None:
+            cache.record(self, key)
+
+    def do_probe(self, mount_point, info):
+        if "swap" in self.type:
+            self.os_fs_info, self.description, self.free_space, self.used_percent = ': '+self.type, 'swap', '', 0
+            self.os_prober = []
+            self.set_html()
+            return
+        if info is not None:
+            if info.available is not None:
+                self.set_usage(info.size, info.used, info.available)
+                if not self.may_hold_os(info):
+                    print("                  . no OS to look for, not mounting it")
+                    # not looked at, os-prober probes it
+                    self.os_prober = None
+                    self.set_html()
+                    return
+
+        mounted = False
         try:
-            print("                  . About to mount it...")
-            os.system('mount --read-only {} {}'.format(self.path, TMP_MOUNTPOINT))
-            size, free, self.used_percent, mount_point = getoutput("df {0} | grep '^{0}' | awk '{{print $2,$4,$5,$6}}' | tail -1".format(self.path)).split(None, 3)
-            self.raw_size = int(size)*1024
-            print("                  . size %s, free %s, self.used_percent %s, mount_point %s" % (size, free, self.used_percent, mount_point))
-        except ValueError:
+            print("                  . About to mount %s on %s..." % (self.path, mount_point))
+            os.makedirs(mount_point, exist_ok=True)
+            argv = ['mount', '--read-only', self.path, mount_point]
+            if info is not None and info.type in MOUNT_OPTIONS:
+                argv[2:2] = ['-t', info.type, '-o', MOUNT_OPTIONS[info.type]]
+            mounted = commands.run(argv, timeout=PROBE_MOUNT_TIMEOUT).returncode == 0
+            if not mounted:
+                # already mounted elsewhere, i.e. by the user
+                mount_point = get_mount_point(self.path)
+                if mount_point is None:
+                    raise ValueError(self.path)
+            stat = os.statvfs(mount_point)
+            size, free = stat.f_blocks * stat.f_frsize, stat.f_bavail * stat.f_frsize
+            used = (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+            print("                  . size %s, free %s, used %s, mount_point %s" % (size, free, used, mount_point))
+        except (ValueError, OSError):
             print("                  . value error!")
-            if "swap" in self.type:
-                self.os_fs_info, self.description, self.free_space, self.used_percent = ': '+self.type, 'swap', '', 0
-            else:
-                print('WARNING: Partition {} or type {} failed to mount!'.format(self.path, partition.type))
-                self.os_fs_info, self.description, self.free_space, self.used_percent = ': '+self.type, '', '', 0
+            print('WARNING: Partition {} or type {} failed to mount!'.format(self.path, self.parted_type))
+            self.os_fs_info, self.description = ': '+self.type, ''
+            self.os_prober = None
+            if info is None or info.available is None:
+                self.free_space, self.used_percent = '', 0
             print("                  . self.os_fs_info %s, self.description %s, self.free_space %s, self.used_percent %s" % (self.os_fs_info, self.description, self.free_space, self.used_percent))
         else:
             print("                  . About to find more about it...")
-            self.size = to_human_readable(int(size)*1024)  # for mountable partitions, more accurate than the getLength size above
-            self.free_space = to_human_readable(int(free)*1024)  # df returns values in 1024B-blocks by default
-            self.used_percent = self.used_percent.strip('%') or 0
+            # for mountable partitions, more accurate than the getLength size above
+            self.set_usage(size, used, free)
             description = ''
             if path_exists(mount_point, 'etc/gooroom/info'):
                 description = getoutput("cat %s/etc/gooroom/info | grep GRUB_TITLE" % mount_point).replace('GRUB_TITLE', '').replace('=', '').replace('"', '').strip()
@@ -510,25 +733,42 @@ class Partition(object):
             elif path_exists(mount_point, 'etc/'):
                 description = getoutput("su -c '{{ . {0}/etc/lsb-release && echo $DISTRIB_DESCRIPTION; }} || \
                                                 {{ . {0}/etc/os-release && echo $PRETTY_NAME; }}' gooroom".format(mount_point)) or 'Unix'
-            else:
-                try:
-                    if partition.active:
-                        for flag in partition.getFlagsAsString().split(", "):
-                            if flag in ["boot", "esp"]:
-                                description = 'EFI System Partition'
-                                self.mount_as = EFI_MOUNT_POINT
-                                break
-                except Exception as detail:
-                    # best effort
-                    print("Could not read partition flags for %s: %s" % (self.path, detail))
+            elif "boot" in self.flags or "esp" in self.flags:
+                description = 'EFI System Partition'
+                self.mount_as = EFI_MOUNT_POINT
             self.description = description
+            self.os_prober = osprober.detect(self.path, mount_point, description)
             self.os_fs_info = ': {0.description} ({0.type}; {0.size}; {0.free_space})'.format(self) if description else ': ' + self.type
             print("                  . self.description %s self.os_fs_info %s" % (self.description, self.os_fs_info))
         finally:
-            print("                  . umounting it")
-            os.system('umount ' + TMP_MOUNTPOINT + ' 2>/dev/null')
+            if mounted:
+                print("                  . umounting it")
+                commands.run(['umount', mount_point], timeout=PROBE_MOUNT_TIMEOUT, log=None)
+                try:
+                    os.rmdir(mount_point)
+                except OSError:
+                    pass
             print("                  . done")
-
+        self.set_html()
+
+    def set_usage(self, size, used, available):
+        self.raw_size = size
+        self.size = to_human_readable(size)
+        self.free_space = to_human_readable(available)
+        # like df, rounded up
+        self.used_percent = -(-used * 100 // (used + available)) if used + available else 0
+
+    def may_hold_os(self, info):
+        ''' Whether the OS detection has to look at the files of the filesystem info '''
+        if info.type == 'vfat':
+            # the bootloaders of the other systems are on the EFI system partition
+            return "boot" in self.flags or "esp" in self.flags
+        if info.type in ('ext2', 'ext3', 'ext4') and info.last_mounted:
+            # where the filesystem was mounted last, /home and the like hold no system
+            return info.last_mounted.rstrip('/') not in DATA_MOUNT_POINTS and not info.last_mounted.startswith('/home/')
+        return True
+
+    def set_html(self):
         self.html_name = self.name.split('/')[-1]
         self.html_description = self.description
         if (self.size_percent < 10 and len(self.description) > 5):
@@ -538,26 +778,6 @@ class Partition(object):
             self.html_name = ""
             self.html_description = ""
 
-        self.color = {
-            # colors approximately from gparted (find matching set in usr/share/disk-partitions.html)
-            'btrfs': '#636363',
-            'exfat': '#47872a',
-            'ext2':  '#2582a0',
-            'ext3':  '#2582a0',
-            'ext4':  '#21619e',
-            'fat16': '#47872a',
-            'fat32': '#47872a',
-            'hfs':   '#636363',
-            'jfs':   '#636363',
-            'swap':  '#be3a37',
-            'ntfs':  '#66a6a8',
-            'reiserfs': '#636363',
-            'ufs':   '#636363',
-            'xfs':   '#636363',
-            'zfs':   '#636363',
-            parted.PARTITION_EXTENDED: '#a9a9a9',
-        }.get(self.type, '#a9a9a9')
-
     def print_partition(self):
         print("Device: %s, format as: %s, mount as: %s" % (self.path, self.format_as, self.mount_as))
 
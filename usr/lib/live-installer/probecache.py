@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+import threading
+
+try:
+    import gi
+    gi.require_version('GUdev', '1.0')
+    from gi.repository import GUdev
+except (ImportError, ValueError):
+    GUdev = None
+
+# what the probe of a partition finds, see Partition.probe
+PROBED = ('size', 'raw_size', 'free_space', 'used_percent', 'description', 'os_fs_info', 'os_prober', 'uuid', 'mount_as')
+# a "change" uevent with the same values changed nothing the probe looks at; parted and
+# gparted only opening a disk read-write are enough for udev to send one
+UDEV_PROPERTIES = ('ID_FS_TYPE', 'ID_FS_UUID', 'ID_FS_LABEL', 'ID_FS_VERSION',
+                   'ID_PART_ENTRY_OFFSET', 'ID_PART_ENTRY_SIZE', 'ID_PART_ENTRY_TYPE')
+
+
+class ProbeCache(object):
+    ''' The results of the partition probes, kept from one scan of the partitioning screen to the next.
+
+    An entry is keyed by the partition device, its geometry, its filesystem UUID
+    and the generation of the device. udev events about a device (through GUdev)
+    bump its generation and so invalidate what was found there. Without GUdev
+    nothing tells that a filesystem changed, the cache stays empty. '''
+
+    def __init__(self):
+        self.entries = {}
+        self.generations = {}
+        self.properties = {}
+        self.client = None
+        self._lock = threading.Lock()
+
+    def watch(self):
+        ''' Starts listening to the udev events of the block devices, from the GLib main loop '''
+        if self.client is not None:
+            return True
+        if GUdev is None:
+            print("GUdev is not available, the partitions are probed again on every scan")
+            return False
+        self.client = GUdev.Client(subsystems=['block'])
+        for device in self.client.query_by_subsystem('block'):
+            if device.get_device_file():
+                self.properties[device.get_device_file()] = self._get_properties(device)
+        self.client.connect('uevent', self._uevent)
+        return True
+
+    @property
+    def enabled(self):
+        return self.client is not None
+
+    def _get_properties(self, device):
+        return tuple(device.get_property(name) for name in UDEV_PROPERTIES)
+
+    def _uevent(self, client, action, device):
+        path = device.get_device_file()
+        if not path:
+            return
+        properties = self._get_properties(device)
+        if action == 'change' and self.properties.get(path) == properties:
+            return
+        self.properties[path] = properties
+        print("udev: %s %s, probing it again on the next scan" % (action, path))
+        self.invalidate(path)
+
+    def invalidate(self, device=None):
+        with self._lock:
+            if device is None:
+                self.entries = {}
+            else:
+                self.generations[device] = self.generations.get(device, 0) + 1
+                self.entries.pop(device, None)
+
+    def get_key(self, partition):
+        ''' The key of what the probe of partition finds now, to take before probing it '''
+        with self._lock:
+            return (partition.start, partition.length, partition.uuid, self.generations.get(partition.path, 0))
+
+    def lookup(self, partition, key):
+        ''' Fills partition in with what an earlier probe found, returns False if there is nothing valid '''
+        if not self.enabled:
+            return False
+        with self._lock:
+            entry = self.entries.get(partition.path)
+            if entry is None or entry[0] != key:
+                return False
+            values = entry[1]
+        for name, value in values.items():
+            setattr(partition, name, list(value) if isinstance(value, list) else value)
+        return True
+
+    def record(self, partition, key):
+        if not self.enabled:
+            return
+        values = dict((name, getattr(partition, name)) for name in PROBED)
+        with self._lock:
+            # an event came during the probe, what was found may be stale already
+            if key[-1] == self.generations.get(partition.path, 0):
+                self.entries[partition.path] = (key, values)
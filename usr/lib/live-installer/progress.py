@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+import time
+import itertools
+
+# How often the frontend redraws the progress at most
+PROGRESS_FPS = 25
+
+
+class ProgressSlot(object):
+    ''' Holds the latest progress of the installation.
+
+    The engine publishes every update into the slot, however often, and the
+    frontend pulls from it at PROGRESS_FPS, so a tight copy loop coalesces into
+    a handful of redraws per second instead of one main loop callback per file.
+    Publishing only replaces a tuple, which is atomic, so the engine threads
+    never take a lock nor wait for the UI. '''
+
+    def __init__(self, fps=PROGRESS_FPS):
+        self.interval = 1.0 / fps
+        self._counter = itertools.count(1)
+        self._state = (0, (0, 0, False, False, ''))
+        self._hook = None
+        self._hook_state = (0, None, 0)  # (seq, pulse, time) of the last update pushed to the hook
+
+    def publish(self, current, total, pulse, done, message):
+        ''' i.e. the engine's update_progress(current, total, pulse, done, message) '''
+        self._state = (next(self._counter), (current, total, pulse, done, message))
+        if self._hook is not None:
+            self._push()
+
+    def get(self):
+        ''' Returns (seq, (current, total, pulse, done, message)), seq changes with every publish() '''
+        return self._state
+
+    def set_hook(self, progresshook):
+        ''' Push the updates to progresshook, no more than fps times per second.
+        Switching between pulse and normal mode and the final "done" update are never dropped. '''
+        self._hook = progresshook
+
+    def _push(self):
+        seq, update = self._state
+        last_seq, last_pulse, last_time = self._hook_state
+        now = time.monotonic()
+        if seq <= last_seq:
+            return
+        if now - last_time < self.interval and update[2] == last_pulse and not update[3]:
+            return
+        self._hook_state = (seq, update[2], now)
+        self._hook(*update)
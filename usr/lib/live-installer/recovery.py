@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+import os
+import re
+import threading
+
+# the archives gooroom-recovery restores, at the top of the recovery partition
+ROOT_ARCHIVE = 'gooroom_root_partition.fsa'
+BOOTEFI_ARCHIVE = 'gooroom_bootefi_partition.fsa'
+
+# fsarchiver -v prints "-[00][ 42%][REGFILE ] /usr/bin/foo" for every file it saves
+PROGRESS_LINE = re.compile(r'^-\[\d+\]\[\s*(\d+)%\]\[[^]]*\]')
+
+
+def savefs_argv(archive, device, level=None, threads=None):
+    ''' The fsarchiver command saving the filesystem of device to archive '''
+    argv = ["fsarchiver", "savefs", "-o", "-v"]
+    if level:
+        argv += ["-z", str(level)]
+    if threads:
+        argv += ["-j", str(threads)]
+    return argv + [archive, device]
+
+
+def get_threads(threads):
+    ''' The compression threads of each fsarchiver, 0 is one per CPU '''
+    return threads if threads > 0 else (os.cpu_count() or 1)
+
+
+class ArchiveProgress(object):
+    ''' The progress of several fsarchiver running at once, each of them weighted
+    by the size of the filesystem it saves '''
+
+    def __init__(self, weights, callback):
+        self.weights = weights
+        self.callback = callback
+        self.percents = dict((name, 0) for name in weights)
+        self._lock = threading.Lock()
+
+    def get_logger(self, name, log=print):
+        ''' A log function for commands.run, which turns the per-file lines of the
+        archive name into progress and passes everything else to log '''
+        def _log(line):
+            match = PROGRESS_LINE.match(line.strip())
+            if match is None:
+                log(line)
+            else:
+                self.update(name, int(match.group(1)))
+        return _log
+
+    def update(self, name, percent):
+        with self._lock:
+            if percent == self.percents[name]:
+                return
+            self.percents[name] = percent
+            total = sum(self.weights.values()) or 1
+            done = sum(self.weights[key] * self.percents[key] for key in self.weights) / total
+        self.callback(done)
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+import threading
+
+
+class Step(object):
+
+    def __init__(self, name, func, args, requires, resources):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.requires = tuple(requires)
+        self.resources = tuple(resources)
+
+
+class StepScheduler(object):
+    ''' Runs a DAG of named installation steps.
+
+    A step starts as soon as the steps it requires are done, so independent
+    steps run concurrently. Resources are exclusive: two steps declaring the
+    same resource (e.g. "dpkg") never run at the same time. Requiring a step
+    which was not added (because it does not apply to this installation) is
+    allowed and always satisfied.
+
+    Use as:
+
+        scheduler = StepScheduler(engine.run_step)
+        scheduler.add("write_hostname", engine.step_write_hostname, setup)
+        scheduler.add("clean_apt", engine.step_clean_apt, setup, requires=["write_hostname"], resources=["dpkg"])
+        scheduler.run()
+    '''
+
+    def __init__(self, run_step, max_workers=4):
+        self.run_step = run_step
+        self.max_workers = max_workers
+        self.steps = []
+
+    def add(self, name, func, *args, requires=(), resources=()):
+        self.steps.append(Step(name, func, args, requires, resources))
+
+    def _check(self):
+        names = set(step.name for step in self.steps)
+        order, visited = [], {}
+        def _visit(step, path):
+            if visited.get(step.name) == 'done':
+                return
+            if visited.get(step.name) == 'visiting':
+                raise ValueError("Cyclic step dependencies: %s" % ' -> '.join(path + [step.name]))
+            visited[step.name] = 'visiting'
+            for name in step.requires:
+                if name in names:
+                    _visit(self._get(name), path + [step.name])
+            visited[step.name] = 'done'
+        for step in self.steps:
+            _visit(step, [])
+
+    def _get(self, name):
+        for step in self.steps:
+            if step.name == name:
+                return step
+
+    def run(self):
+        ''' Run every step, raise the first exception raised by a step once the running ones are over '''
+        self._check()
+        names = set(step.name for step in self.steps)
+        pending = list(self.steps)
+        done, busy = set(), set()
+        running = []
+        errors = []
+        condition = threading.Condition()
+
+        def _run(step):
+            try:
+                self.run_step(step.name, step.func, *step.args)
+            except Exception as detail:
+                print("Step '%s' failed: %s" % (step.name, detail))
+                with condition:
+                    errors.append(detail)
+            finally:
+                with condition:
+                    done.add(step.name)
+                    busy.difference_update(step.resources)
+                    running.remove(step)
+                    condition.notify()
+
+        with condition:
+            while pending or running:
+                if not errors:
+                    for step in list(pending):
+                        if len(running) >= self.max_workers:
+                            break
+                        if any(name in names and name not in done for name in step.requires):
+                            continue
+                        if busy.intersection(step.resources):
+                            continue
+                        pending.remove(step)
+                        running.append(step)
+                        busy.update(step.resources)
+                        thread = threading.Thread(target=_run, args=(step,), name=step.name)
+                        thread.daemon = True
+                        thread.start()
+                elif not running:
+                    break
+                condition.wait()
+        if errors:
+            raise errors[0]
@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+import struct
+
+# the filesystems read here, blkid's names
+TYPES = ('ext2', 'ext3', 'ext4', 'vfat', 'ntfs', 'btrfs', 'xfs')
+
+EXT_SUPERBLOCK = 1024
+EXT_MAGIC = 0xEF53
+EXT_COMPAT_HAS_JOURNAL = 0x4
+EXT_INCOMPAT_EXTENTS = 0x40
+EXT_INCOMPAT_64BIT = 0x80
+EXT_INCOMPAT_FLEX_BG = 0x200
+BTRFS_SUPERBLOCK = 0x10000
+BTRFS_MAGIC = b'_BHRfS_M'
+FAT_FSINFO_LEAD = 0x41615252
+FAT_FSINFO_STRUCT = 0x61417272
+
+
+class FilesystemInfo(object):
+    ''' What the superblock of a filesystem tells, sizes in bytes. used and available
+    are like df's (available leaves out the reserved blocks), None when unknown. '''
+
+    def __init__(self, type, size, used=None, available=None, label='', uuid=None, last_mounted=None):
+        self.type = type
+        self.size = size
+        self.used = used
+        self.available = available
+        self.label = label
+        self.uuid = uuid
+        self.last_mounted = last_mounted
+
+    def __repr__(self):
+        return "<%s %s size=%s used=%s available=%s label=%r uuid=%s>" % (
+            self.__class__.__name__, self.type, self.size, self.used, self.available, self.label, self.uuid)
+
+
+def _string(data):
+    return data.split(b'\0', 1)[0].decode('utf-8', 'replace').strip()
+
+
+def _uuid(data):
+    hex = data.hex()
+    return '-'.join((hex[:8], hex[8:12], hex[12:16], hex[16:20], hex[20:32]))
+
+
+def read_ext(head):
+    sb = head[EXT_SUPERBLOCK:EXT_SUPERBLOCK + 1024]
+    if len(sb) < 1024 or struct.unpack_from('<H', sb, 0x38)[0] != EXT_MAGIC:
+        return None
+    blocks, reserved, free = struct.unpack_from('<III', sb, 0x4)
+    block_size = 1024 << struct.unpack_from('<I', sb, 0x18)[0]
+    compat, incompat = struct.unpack_from('<II', sb, 0x5C)
+    if incompat & EXT_INCOMPAT_64BIT:
+        blocks_hi, reserved_hi, free_hi = struct.unpack_from('<III', sb, 0x150)
+        blocks, reserved, free = blocks | blocks_hi << 32, reserved | reserved_hi << 32, free | free_hi << 32
+    if incompat & (EXT_INCOMPAT_EXTENTS | EXT_INCOMPAT_64BIT | EXT_INCOMPAT_FLEX_BG):
+        type = 'ext4'
+    elif compat & EXT_COMPAT_HAS_JOURNAL:
+        type = 'ext3'
+    else:
+        type = 'ext2'
+    return FilesystemInfo(type, blocks * block_size, (blocks - free) * block_size, max(0, free - reserved) * block_size,
+                          _string(sb[0x78:0x88]), _uuid(sb[0x68:0x78]), _string(sb[0x88:0xC8]))
+
+
+def read_vfat(head):
+    if len(head) < 512 or head[510:512] != b'\x55\xaa':
+        return None
+    sector_size, cluster_sectors, reserved_sectors, fats, root_entries, sectors16 = struct.unpack_from('<HBHBHH', head, 11)
+    fat_sectors, = struct.unpack_from('<H', head, 22)
+    sectors32, = struct.unpack_from('<I', head, 32)
+    if fat_sectors == 0:
+        if head[82:87] != b'FAT32':
+            return None
+        fat_sectors, = struct.unpack_from('<I', head, 36)
+        fsinfo, = struct.unpack_from('<H', head, 48)
+        serial, = struct.unpack_from('<I', head, 67)
+        label = head[71:82]
+    else:
+        if head[54:57] != b'FAT':
+            return None
+        fsinfo = None
+        serial, = struct.unpack_from('<I', head, 39)
+        label = head[43:54]
+    if sector_size not in (512, 1024, 2048, 4096) or not cluster_sectors:
+        return None
+    size = (sectors16 or sectors32) * sector_size
+    used = available = None
+    if fsinfo and (fsinfo + 1) * sector_size <= len(head):
+        info = head[fsinfo * sector_size:(fsinfo + 1) * sector_size]
+        lead, = struct.unpack_from('<I', info, 0)
+        signature, free_clusters = struct.unpack_from('<II', info, 484)
+        if lead == FAT_FSINFO_LEAD and signature == FAT_FSINFO_STRUCT and free_clusters != 0xFFFFFFFF:
+            data = size - (reserved_sectors + fats * fat_sectors) * sector_size
+            available = free_clusters * cluster_sectors * sector_size
+            used = max(0, data - available)
+    label = _string(label)
+    if label == 'NO NAME':
+        label = ''
+    return FilesystemInfo('vfat', size, used, available, label, "%04X-%04X" % (serial >> 16, serial & 0xFFFF))
+
+
+def read_ntfs(head):
+    if len(head) < 512 or head[3:11] != b'NTFS    ':
+        return None
+    sector_size, = struct.unpack_from('<H', head, 11)
+    sectors, = struct.unpack_from('<Q', head, 40)
+    # 48 and 56 are the clusters of the MFT and of its mirror
+    serial, = struct.unpack_from('<Q', head, 72)
+    # the label and the free space are in the MFT, mounting tells them
+    return FilesystemInfo('ntfs', sectors * sector_size, uuid="%016X" % serial)
+
+
+def read_btrfs(data):
+    if len(data) < 0x22B or data[0x40:0x48] != BTRFS_MAGIC:
+        return None
+    size, used = struct.unpack_from('<QQ', data, 0x70)
+    return FilesystemInfo('btrfs', size, used, max(0, size - used), _string(data[0x12B:0x22B]), _uuid(data[0x20:0x30]))
+
+
+def read_xfs(head):
+    if len(head) < 160 or head[0:4] != b'XFSB':
+        return None
+    block_size, blocks = struct.unpack_from('>IQ', head, 4)
+    # with lazy counters, the free blocks of the primary superblock are only updated at unmount
+    free, = struct.unpack_from('>Q', head, 144)
+    return FilesystemInfo('xfs', blocks * block_size, (blocks - free) * block_size, free * block_size,
+                          _string(head[108:120]), _uuid(head[32:48]))
+
+
+def read(device):
+    ''' The FilesystemInfo of the filesystem on device, read from its superblock
+    (a few KB), or None if it is none of TYPES '''
+    try:
+        with open(device, 'rb') as f:
+            head = f.read(8192)
+            info = read_ext(head) or read_xfs(head) or read_ntfs(head) or read_vfat(head)
+            if info is None:
+                f.seek(BTRFS_SUPERBLOCK)
+                info = read_btrfs(f.read(4096))
+    except (IOError, OSError, struct.error):
+        return None
+    return info
+
+
+if __name__ == "__main__":
+    import sys
+    for device in sys.argv[1:]:
+        print(device, read(device))
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+import os
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+LOG_DIR = '/var/log/live-installer'
+
+
+def _cpu_time(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def exit_status(status):
+    ''' Turns an os.system()/wait() status into an exit code (negative for signals) '''
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class TimelineStep(object):
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.thread = threading.current_thread().name
+        self.start = time.time()
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.bytes = 0
+        self.status = None
+        # the CPU time of the commands run by the step, from their own rusage
+        self.children_cpu = 0.0
+        self._start_wall = time.monotonic()
+        self._start_cpu = _cpu_time(resource.RUSAGE_THREAD)
+
+    def finish(self):
+        self.wall = time.monotonic() - self._start_wall
+        # RUSAGE_CHILDREN is process-wide, it would charge a step with what the concurrent ones run
+        self.cpu = _cpu_time(resource.RUSAGE_THREAD) - self._start_cpu + self.children_cpu
+
+    def as_dict(self):
+        return {'name': self.name,
+                'category': self.category,
+                'thread': self.thread,
+                'start': self.start,
+                'wall_time': round(self.wall, 6),
+                'cpu_time': round(self.cpu, 6),
+                'bytes': self.bytes,
+                'status': self.status,
+                'args': self.args}
+
+
+class InstallTimeline(object):
+    ''' Records the wall time, CPU time, bytes and exit status of every engine step,
+    so that install profiles can be compared across hardware models and ISO builds.
+
+    Use as:
+
+        with timeline.step("mkfs /dev/sda2", "mkfs") as step:
+            step.status = ...
+    '''
+
+    def __init__(self):
+        self.steps = []
+        self.start = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def step(self, name, category, **args):
+        step = TimelineStep(name, category, args)
+        stack = self._stack()
+        stack.append(step)
+        try:
+            yield step
+        except Exception as detail:
+            if step.status is None:
+                step.status = str(detail)
+            raise
+        finally:
+            stack.pop()
+            step.finish()
+            with self._lock:
+                self.steps.append(step)
+
+    def current(self):
+        ''' The innermost step running in this thread, or None '''
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def add_bytes(self, count):
+        step = self.current()
+        if step is not None:
+            step.bytes += count
+
+    def set_status(self, status):
+        step = self.current()
+        if step is not None:
+            step.status = status
+
+    def add_rusage(self, rusage):
+        ''' Charges the CPU time of a command (its os.wait4 rusage) to the steps running it in this thread '''
+        if rusage is None:
+            return
+        for step in self._stack():
+            step.children_cpu += rusage.ru_utime + rusage.ru_stime
+
+    def add_command(self, argv, duration, rusage, status):
+        ''' Records a command which ran for duration seconds, as a step of its own, and charges its CPU
+        time to the steps running it. The status of those steps is theirs to set. '''
+        step = TimelineStep(" ".join(argv), "command", {})
+        step.start -= duration
+        step.wall = duration
+        step.cpu = rusage.ru_utime + rusage.ru_stime if rusage is not None else 0.0
+        step.status = status
+        self.add_rusage(rusage)
+        with self._lock:
+            self.steps.append(step)
+
+    def get_info(self):
+        info = {'start': self.start}
+        for key, path in (('product', '/sys/class/dmi/id/product_name'),
+                          ('vendor', '/sys/class/dmi/id/sys_vendor'),
+                          ('iso', '/run/live/medium/.disk/info')):
+            try:
+                with open(path) as f:
+                    info[key] = f.read().strip()
+            except IOError:
+                pass
+        info['cpus'] = os.cpu_count()
+        return info
+
+    def write(self, directory=LOG_DIR, **info):
+        ''' Writes timeline.json and timeline-trace.json (chrome://tracing, Perfetto) to directory '''
+        with self._lock:
+            steps = sorted(self.steps, key=lambda step: step.start)
+        info.update(self.get_info())
+        threads = {}
+        events = []
+        for step in steps:
+            tid = threads.setdefault(step.thread, len(threads) + 1)
+            args = dict(step.args, cpu_time=round(step.cpu, 6), bytes=step.bytes, status=step.status)
+            events.append({'name': step.name,
+                           'cat': step.category,
+                           'ph': 'X',
+                           'ts': int((step.start - self.start) * 1000000),
+                           'dur': int(step.wall * 1000000),
+                           'pid': 1,
+                           'tid': tid,
+                           'args': args})
+        for thread, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': thread}})
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, 'timeline.json'), 'w') as f:
+                json.dump({'info': info, 'steps': [step.as_dict() for step in steps]}, f, indent=1)
+            with open(os.path.join(directory, 'timeline-trace.json'), 'w') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': info}, f)
+            print(" --> Wrote the installation timeline to %s" % directory)
+        except (IOError, OSError) as detail:
+            print("WARNING: Could not write the installation timeline: %s" % detail)
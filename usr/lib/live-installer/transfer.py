@@ -0,0 +1,501 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+import os
+import sys
+import re
+import stat
+import errno
+import fnmatch
+import time
+import threading
+import gettext
+from concurrent.futures import ThreadPoolExecutor
+
+import commands
+
+gettext.install("live-installer", "/usr/share/gooroom/locale")
+
+# Paths of the live filesystem which are not copied to the target (relative to /source)
+EXCLUDE_DIRS = "home/* dev/* proc/* sys/* tmp/* run/* mnt/* media/* lost+found source target".split()
+
+COPY_CHUNK = 8 * 1024 * 1024
+
+
+def default_workers():
+    # copy_file_range()/sendfile() release the GIL, so the pool is bound by
+    # the disks rather than by the interpreter
+    return min(32, (os.cpu_count() or 1) * 4)
+
+
+def is_excluded(rel_path, exclude):
+    for pattern in exclude:
+        if fnmatch.fnmatchcase(rel_path, pattern):
+            return True
+    return False
+
+
+def top_entries(source):
+    # like the "{src}*" shell glob used with rsync, hidden top-level entries are not copied
+    return sorted(name for name in os.listdir(source) if not name.startswith('.'))
+
+
+def walk_tree(source, exclude=(), onerror=None, entries=None):
+    ''' Yields (rel_path, stat) for everything below source (or below its given
+    top-level entries) in top-down order '''
+    if entries is None:
+        entries = top_entries(source)
+    stack = list(reversed(entries))
+    while stack:
+        rel_path = stack.pop()
+        if is_excluded(rel_path, exclude):
+            continue
+        try:
+            st = os.lstat(os.path.join(source, rel_path))
+        except OSError as detail:
+            if onerror is not None:
+                onerror(rel_path, detail)
+            continue
+        yield rel_path, st
+        if stat.S_ISDIR(st.st_mode):
+            try:
+                names = sorted(os.listdir(os.path.join(source, rel_path)))
+            except OSError as detail:
+                if onerror is not None:
+                    onerror(rel_path, detail)
+                continue
+            stack.extend(os.path.join(rel_path, name) for name in reversed(names))
+
+
+def copy_xattrs(src, dst, follow_symlinks=True):
+    ''' Copy extended attributes, which also carries POSIX ACLs (system.posix_acl_*) '''
+    try:
+        names = os.listxattr(src, follow_symlinks=follow_symlinks)
+    except OSError as e:
+        if e.errno in (errno.ENOTSUP, errno.ENODATA):
+            return
+        raise
+    for name in names:
+        try:
+            value = os.getxattr(src, name, follow_symlinks=follow_symlinks)
+            os.setxattr(dst, name, value, follow_symlinks=follow_symlinks)
+        except OSError as e:
+            # user.* is not allowed on symlinks, some namespaces are not
+            # supported by every target filesystem
+            if e.errno not in (errno.EPERM, errno.ENOTSUP, errno.ENODATA):
+                raise
+
+
+def copy_data(fsrc, fdst, size):
+    offset = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(fsrc, fdst, min(COPY_CHUNK, size - offset))
+                if copied == 0:
+                    break
+                offset += copied
+            return offset
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    while offset < size:
+        sent = os.sendfile(fdst, fsrc, offset, min(COPY_CHUNK, size - offset))
+        if sent == 0:
+            break
+        offset += sent
+    return offset
+
+
+class FileTransfer(object):
+    ''' Copies a directory tree into another with a pool of worker threads.
+
+    Behaves like "rsync --archive --no-D --acls --hard-links --xattrs":
+    ownership, modes, timestamps, ACLs, xattrs, symlinks and hard links are
+    preserved, device and special files are skipped.
+    Paths matching one of the exclude patterns (relative to the source, e.g.
+    "home/*" or "lost+found") are not copied. '''
+
+    def __init__(self, source, dest, exclude=(), workers=None, skip_existing=False):
+        self.source = source.rstrip('/') or '/'
+        self.dest = dest.rstrip('/') or '/'
+        self.exclude = list(exclude)
+        self.workers = workers or default_workers()
+        # like rsync's quick check: files with the same size and mtime are not copied again
+        self.skip_existing = skip_existing
+        self.files_done = 0
+        self.bytes_done = 0
+        self.errors = []
+        self.hard_links = {}
+        self._lock = threading.Lock()
+        self._progress = None
+
+    def set_progress_hook(self, progresshook):
+        ''' i.e. def my_callback(files_done, bytes_done, rel_path), called from the worker threads '''
+        self._progress = progresshook
+
+    def _error(self, rel_path, detail):
+        print("transfer: %s: %s" % (rel_path, detail))
+        with self._lock:
+            self.errors.append((rel_path, str(detail)))
+
+    def _done(self, rel_path, size):
+        with self._lock:
+            self.files_done += 1
+            self.bytes_done += size
+            files_done, bytes_done = self.files_done, self.bytes_done
+        if self._progress is not None:
+            self._progress(files_done, bytes_done, rel_path)
+
+    def _set_metadata(self, path, st, follow_symlinks=True):
+        os.chown(path, st.st_uid, st.st_gid, follow_symlinks=follow_symlinks)
+        if follow_symlinks:
+            os.chmod(path, stat.S_IMODE(st.st_mode))
+
+    def _copy_file(self, rel_path, st):
+        src = os.path.join(self.source, rel_path)
+        dst = os.path.join(self.dest, rel_path)
+        if self.skip_existing and self._is_copied(dst, st):
+            self._done(rel_path, st.st_size)
+            return
+        try:
+            if os.path.lexists(dst) and not os.path.isfile(dst):
+                os.unlink(dst)
+            fsrc = os.open(src, os.O_RDONLY)
+            try:
+                fdst = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                try:
+                    copy_data(fsrc, fdst, st.st_size)
+                    # chown clears setuid bits and file capabilities, so it goes first
+                    os.fchown(fdst, st.st_uid, st.st_gid)
+                    os.fchmod(fdst, stat.S_IMODE(st.st_mode))
+                finally:
+                    os.close(fdst)
+            finally:
+                os.close(fsrc)
+            copy_xattrs(src, dst)
+            os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+        except OSError as detail:
+            self._error(rel_path, detail)
+        else:
+            self._done(rel_path, st.st_size)
+
+    def _is_copied(self, dst, st):
+        try:
+            dst_st = os.lstat(dst)
+        except OSError:
+            return False
+        return (stat.S_ISREG(dst_st.st_mode) and dst_st.st_size == st.st_size
+                and dst_st.st_mtime_ns == st.st_mtime_ns)
+
+    def _copy_symlink(self, rel_path, st):
+        src = os.path.join(self.source, rel_path)
+        dst = os.path.join(self.dest, rel_path)
+        try:
+            if os.path.lexists(dst):
+                os.unlink(dst)
+            os.symlink(os.readlink(src), dst)
+            self._set_metadata(dst, st, follow_symlinks=False)
+            copy_xattrs(src, dst, follow_symlinks=False)
+            os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+        except OSError as detail:
+            self._error(rel_path, detail)
+        else:
+            self._done(rel_path, 0)
+
+    def _make_dir(self, rel_path):
+        dst = os.path.join(self.dest, rel_path)
+        try:
+            if os.path.lexists(dst) and not os.path.isdir(dst):
+                os.unlink(dst)
+            os.makedirs(dst, mode=0o700, exist_ok=True)
+            return True
+        except OSError as detail:
+            self._error(rel_path, detail)
+            return False
+
+    def _finish_dir(self, rel_path, st):
+        src = os.path.join(self.source, rel_path)
+        dst = os.path.join(self.dest, rel_path)
+        try:
+            self._set_metadata(dst, st)
+            copy_xattrs(src, dst)
+            os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+        except OSError as detail:
+            self._error(rel_path, detail)
+
+    def _link(self, rel_path, first_rel_path):
+        dst = os.path.join(self.dest, rel_path)
+        try:
+            if os.path.lexists(dst):
+                os.unlink(dst)
+            os.link(os.path.join(self.dest, first_rel_path), dst)
+        except OSError as detail:
+            self._error(rel_path, detail)
+        else:
+            self._done(rel_path, 0)
+
+    def run(self, entries=None):
+        ''' Copy the tree, or only the given top-level entries of it, return the list of (rel_path, error) that failed '''
+        directories = []
+        hard_links = self.hard_links
+        pending_links = []
+        # keep the number of queued copies bounded, the tree has ~300k files
+        slots = threading.BoundedSemaphore(self.workers * 4)
+
+        def _submit(pool, func, *args):
+            slots.acquire()
+            future = pool.submit(func, *args)
+            future.add_done_callback(lambda f: slots.release())
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for rel_path, st in walk_tree(self.source, self.exclude, self._error, entries):
+                mode = st.st_mode
+                if stat.S_ISDIR(mode):
+                    if self._make_dir(rel_path):
+                        directories.append((rel_path, st))
+                        # the manifest counts the directories too
+                        self._done(rel_path, 0)
+                elif stat.S_ISLNK(mode):
+                    _submit(pool, self._copy_symlink, rel_path, st)
+                elif stat.S_ISREG(mode):
+                    if st.st_nlink > 1:
+                        key = (st.st_dev, st.st_ino)
+                        if key in hard_links:
+                            pending_links.append((rel_path, hard_links[key]))
+                            continue
+                        hard_links[key] = rel_path
+                    _submit(pool, self._copy_file, rel_path, st)
+                # devices, fifos and sockets are skipped (rsync --no-D)
+
+        # the first copy of every hard-linked inode is complete at this point
+        for rel_path, first_rel_path in pending_links:
+            self._link(rel_path, first_rel_path)
+
+        # deepest first, so creating entries does not touch the parents' mtime again
+        for rel_path, st in reversed(directories):
+            self._finish_dir(rel_path, st)
+
+        return self.errors
+
+
+def human_size(size):
+    for unit in ['B', 'kB', 'MB', 'GB', 'TB']:
+        if size < 1000:
+            break
+        size /= 1000
+    return "{:.1f} {}".format(size, unit)
+
+
+def human_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return "%d:%02d" % (seconds // 60, seconds % 60)
+
+
+class Manifest(object):
+    ''' Lists what the copy phase transfers: one "size nlink inode path" line per entry.
+
+    The manifest can be shipped next to filesystem.squashfs (see "python3
+    transfer.py --manifest") or built from the mounted source when missing.
+    Only the first path of a hard-linked inode carries bytes, so that
+    bytes_total is what actually gets written to the target. '''
+
+    HEADER = '# live-installer manifest 1'
+
+    def __init__(self):
+        self.sizes = {}
+        self.bytes_total = 0
+        self.files_total = 0
+
+    def _add(self, rel_path, size, nlink, inode, seen):
+        if nlink > 1:
+            if inode in seen:
+                size = 0
+            seen.add(inode)
+        self.sizes[rel_path] = size
+        self.bytes_total += size
+        self.files_total += 1
+
+    @classmethod
+    def build(cls, source, exclude=()):
+        manifest, seen = cls(), set()
+        manifest.entries = []
+        for rel_path, st in walk_tree(source, exclude):
+            if stat.S_ISREG(st.st_mode):
+                size, nlink = st.st_size, st.st_nlink
+            elif stat.S_ISDIR(st.st_mode) or stat.S_ISLNK(st.st_mode):
+                size, nlink = 0, 1
+            else:
+                # devices, fifos and sockets are not copied (rsync --no-D)
+                continue
+            manifest.entries.append((size, nlink, st.st_ino, rel_path))
+            manifest._add(rel_path, size, nlink, st.st_ino, seen)
+        return manifest
+
+    @classmethod
+    def load(cls, path):
+        manifest, seen = cls(), set()
+        with open(path, encoding='utf-8', errors='surrogateescape') as f:
+            if f.readline().rstrip('\n') != cls.HEADER:
+                raise ValueError("%s is not a live-installer manifest" % path)
+            for line in f:
+                size, nlink, inode, rel_path = line.rstrip('\n').split(' ', 3)
+                rel_path = rel_path.replace('\\n', '\n').replace('\\\\', '\\')
+                manifest._add(rel_path, int(size), int(nlink), int(inode), seen)
+        return manifest
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8', errors='surrogateescape') as f:
+            f.write(self.HEADER + '\n')
+            for size, nlink, inode, rel_path in self.entries:
+                rel_path = rel_path.replace('\\', '\\\\').replace('\n', '\\n')
+                f.write('%d %d %d %s\n' % (size, nlink, inode, rel_path))
+
+
+class TransferProgress(object):
+    ''' Turns the per-file notifications of a copy into bytes done/total, files/s, MB/s and an ETA '''
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.files_done = 0
+        self.bytes_done = 0
+        self.start = time.monotonic()
+
+    def add(self, rel_path):
+        ''' Account for rel_path, as reported by rsync; returns False when it is not in the manifest '''
+        size = self.manifest.sizes.get(rel_path.rstrip('/'))
+        if size is None:
+            return False
+        self.files_done += 1
+        self.bytes_done += size
+        return True
+
+    def set(self, files_done, bytes_done):
+        self.files_done, self.bytes_done = files_done, bytes_done
+
+    def get_message(self, rel_path):
+        elapsed = max(time.monotonic() - self.start, 0.001)
+        bytes_total = max(self.manifest.bytes_total, self.bytes_done)
+        speed = self.bytes_done / elapsed
+        if speed > 0:
+            eta = human_duration((bytes_total - self.bytes_done) / speed)
+        else:
+            eta = '?'
+        return _("Copying %(file)s (%(done)s of %(total)s, %(files)d files/s, %(speed)s/s, %(eta)s remaining)") % {
+            'file': rel_path,
+            'done': human_size(self.bytes_done),
+            'total': human_size(bytes_total),
+            'files': self.files_done / elapsed,
+            'speed': human_size(speed),
+            'eta': eta}
+
+
+def run_progress_command(cmd, parse, cancel=None):
+    ''' Runs cmd and hands every output line to parse(line), returns the exit status.
+    Progress bars are redrawn with carriage returns, those split lines too (universal newlines). '''
+    print("EXECUTING: '%s'" % ' '.join(cmd))
+    returncode = commands.run(cmd, cancel=cancel, log=parse, prefix="").returncode
+    print("%s exited with returncode: %d" % (cmd[0], returncode))
+    return returncode
+
+
+class SquashfsExtract(object):
+    ''' Extracts a squashfs image straight into a directory with unsquashfs,
+    which decompresses the blocks with several processors instead of going
+    through the (single-threaded) kernel squashfs driver and a loop mount. '''
+
+    progress_re = re.compile(r'(\d+)/(\d+)\s+(\d+)%')
+
+    def __init__(self, image, dest, exclude=(), workers=None):
+        self.image = image
+        self.dest = dest.rstrip('/') or '/'
+        self.exclude = list(exclude)
+        self.workers = workers or os.cpu_count() or 1
+        self.returncode = None
+        self._progress = None
+
+    def set_progress_hook(self, progresshook):
+        ''' i.e. def my_callback(current, total), current and total are counted in inodes '''
+        self._progress = progresshook
+
+    def get_command(self):
+        cmd = ['unsquashfs', '-force', '-dest', self.dest, '-processors', str(self.workers), self.image]
+        if self.exclude:
+            # -excludes: the paths after the image are not extracted
+            cmd[-1:-1] = ['-excludes']
+            cmd.extend(self.exclude)
+        return cmd
+
+    def run(self, cancel=None):
+        self.returncode = run_progress_command(self.get_command(), self._parse, cancel)
+        return self.returncode
+
+    def _parse(self, line):
+        match = self.progress_re.search(line)
+        if match is None:
+            if line.strip():
+                print(line.strip())
+            return
+        if self._progress is not None:
+            self._progress(int(match.group(1)), int(match.group(2)))
+
+
+class ImageDeploy(object):
+    ''' Writes a root filesystem image onto a partition block by block and grows it
+    to the partition size. The image is either a raw ext4 image, copied with
+    "e2image -ra" which skips unused blocks, or a partclone image, which only
+    contains the used blocks in the first place. '''
+
+    progress_re = re.compile(r'(\d+(?:\.\d+)?)%')
+
+    def __init__(self, image, device):
+        self.image = image
+        self.device = device
+        self.returncode = None
+        self._progress = None
+
+    def set_progress_hook(self, progresshook):
+        ''' i.e. def my_callback(percent, message) '''
+        self._progress = progresshook
+
+    def is_partclone(self):
+        with open(self.image, 'rb') as f:
+            return f.read(15) == b'partclone-image'
+
+    def get_commands(self):
+        if self.is_partclone():
+            write = ['partclone.ext4', '--restore', '--source', self.image, '--output', self.device]
+        else:
+            write = ['e2image', '-ra', '-p', self.image, self.device]
+        return [(write, _("Writing %(image)s to %(device)s") % {'image': self.image, 'device': self.device}),
+                # resize2fs insists on a freshly checked filesystem
+                (['e2fsck', '-f', '-y', self.device], _("Checking %s") % self.device),
+                (['resize2fs', self.device], _("Resizing %s") % self.device),
+                # every installation gets its own filesystem UUID
+                (['tune2fs', '-U', 'random', self.device], _("Tuning %s") % self.device)]
+
+    def run(self, cancel=None):
+        for cmd, message in self.get_commands():
+            def _parse(line, message=message):
+                match = self.progress_re.search(line)
+                if match is None:
+                    if line.strip():
+                        print(line.strip())
+                elif self._progress is not None:
+                    self._progress(float(match.group(1)), message)
+            self.returncode = run_progress_command(cmd, _parse, cancel)
+            # e2fsck exits with 1 when it corrected errors
+            if self.returncode != 0 and not (cmd[0] == 'e2fsck' and self.returncode == 1):
+                return self.returncode
+        self.returncode = 0
+        return self.returncode
+
+
+if __name__ == "__main__":
+    # Build the manifest shipped next to filesystem.squashfs, e.g.
+    #   python3 transfer.py --manifest /mnt/squashfs-root filesystem.files
+    if len(sys.argv) != 4 or sys.argv[1] != '--manifest':
+        sys.exit("usage: %s --manifest SOURCE_DIR OUTPUT" % sys.argv[0])
+    Manifest.build(sys.argv[2], EXCLUDE_DIRS).save(sys.argv[3])